@@ -0,0 +1,395 @@
+import pyarrow as pa
+import pyarrow.csv as csv
+import numpy as np
+import argparse
+import datetime
+import functools
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import schemas
+
+# Benchmarks the pipeline stages against synthetic cumulative reports served from a local stand-in for
+#  DTCC, e.g.
+#   python3 benchmark.py --days 30 --rows-per-day 50000 --json results.json
+# Each stage runs in a fresh process inside the work directory, so its peak RSS is its own.  Stages
+#  build on the output of the ones before them
+
+# Source columns of the values the synthetic reports fill in, for each report layout.  Everything
+#  else is left blank
+REPORT_COLUMNS = {
+    "PRE_2023": {
+        "id": "Dissemination ID",
+        "original": "Original Dissemination ID",
+        "action": "Action",
+        "event_timestamp": "Event Timestamp",
+        "asset_class": "Primary Asset Class",
+        "underlier": "Underlying Asset ID",
+        "notional": "Notional Amount 1",
+        "currency": "Notional Currency 1",
+    },
+    "PRE_PHASE_2": {
+        "id": "Dissemination Identifier",
+        "original": "Original Dissemination Identifier",
+        "action": "Action type",
+        "event_timestamp": "Event timestamp",
+        "asset_class": "Asset Class",
+        "underlier": "Underlier ID-Leg 1",
+        "notional": "Notional amount-Leg 1",
+        "currency": "Notional currency-Leg 1",
+    },
+}
+REPORT_COLUMNS["PHASE_2"] = REPORT_COLUMNS["PRE_PHASE_2"]
+
+# Underliers of the swaps that aren't on the watchlist
+OTHER_UNDERLIERS = [
+    "AAPL.OQ",
+    "MSFT.OQ",
+    "TSLA.OQ",
+    "AMC.N",
+    "BBBY.OQ",
+    "US0378331005",
+    "US5949181045",
+    "SPY",
+]
+
+AMENDMENT_ACTIONS = ["MODI", "CORR", "TERM"]
+
+STAGES = ["ingest", "process", "locate", "locate_indexed", "find_parents", "coalesce"]
+
+
+def generate_records(dates, rows_per_day, amend_rate, watch_share, watch_ids, seed):
+    # The records first reported on each of `dates`.  `amend_rate` of each day's records amend an earlier record (most
+    #  often a recent one), building chains of amendments that keep their original's underlier;
+    #  `watch_share` of the new swaps are on one of `watch_ids`
+    rng = np.random.default_rng(seed)
+    underliers = np.array(watch_ids + OTHER_UNDERLIERS, dtype=object)
+    weights = np.concatenate(
+        [
+            np.full(len(watch_ids), watch_share / len(watch_ids)),
+            np.full(len(OTHER_UNDERLIERS), (1 - watch_share) / len(OTHER_UNDERLIERS)),
+        ]
+    )
+
+    all_ids = np.empty(0, dtype=np.int64)
+    all_underliers = np.empty(0, dtype=object)
+    next_id = 10**9
+    records = []
+
+    for date in dates:
+        ids = np.arange(next_id, next_id + rows_per_day, dtype=np.int64)
+        next_id += rows_per_day
+
+        underlier = rng.choice(underliers, rows_per_day, p=weights)
+        amends = np.zeros(rows_per_day, dtype=bool)
+        originals = np.zeros(rows_per_day, dtype=np.int64)
+
+        if len(all_ids):
+            # Amendments pick an earlier record, most often one of the latest quarter
+            amends = rng.random(rows_per_day) < amend_rate
+            back = rng.geometric(min(1.0, 4 / len(all_ids)), rows_per_day)
+            picks = len(all_ids) - np.minimum(back, len(all_ids))
+
+            originals = all_ids[picks]
+            underlier = np.where(amends, all_underliers[picks], underlier)
+
+        actions = np.where(
+            amends, rng.choice(AMENDMENT_ACTIONS, rows_per_day), "NEWT"
+        ).astype(object)
+        notionals = np.where(
+            rng.random(rows_per_day) < 0.1,
+            "1,000,000+",
+            rng.integers(1, 1000, rows_per_day).astype(str).astype(object) + "000",
+        ).astype(object)
+        timestamps = np.datetime64(date, "s") + rng.integers(0, 86400, rows_per_day)
+
+        records.append(
+            {
+                "id": ids,
+                "original": pa.array(originals, mask=~amends),
+                "action": actions,
+                "timestamp": timestamps,
+                "underlier": underlier,
+                "notional": notionals,
+            }
+        )
+
+        all_ids = np.concatenate([all_ids, ids])
+        all_underliers = np.concatenate([all_underliers, underlier])
+
+    return records
+
+
+def report_csv(schema_name, records):
+    # CSV text of a report in `schema_name`'s layout holding `records`
+    schema = getattr(schemas, schema_name)
+    columns = REPORT_COLUMNS[schema_name]
+    rows = len(records["id"])
+
+    # Older reports have naive timestamps, newer ones are in UTC
+    suffix = "" if schema_name == "PRE_2023" else "Z"
+    timestamps = np.datetime_as_string(records["timestamp"], unit="s")
+
+    values = {
+        columns["id"]: pa.array(records["id"]).cast(pa.string()),
+        columns["original"]: records["original"].cast(pa.string()),
+        columns["action"]: pa.array(records["action"], pa.string()),
+        columns["event_timestamp"]: pa.array(
+            np.char.add(timestamps.astype(str), suffix), pa.string()
+        ),
+        columns["asset_class"]: pa.repeat(pa.scalar("EQ"), rows),
+        columns["underlier"]: pa.array(records["underlier"], pa.string()),
+        columns["notional"]: pa.array(records["notional"], pa.string()),
+        columns["currency"]: pa.repeat(pa.scalar("USD"), rows),
+    }
+
+    table = pa.table(
+        [values.get(name, pa.nulls(rows, pa.string())) for name in schema.names],
+        names=schema.names,
+    )
+
+    out = io.BytesIO()
+    csv.write_csv(table, out)
+
+    return out.getvalue()
+
+
+def write_reports(workdir, days, rows_per_day, overlap, amend_rate, watch_share, seed):
+    # Write a cumulative report zip for each of the last `days` business days to "<workdir>/server",
+    #  the oldest third in the PRE_2023 layout, the next in PRE_PHASE_2 and the newest in PHASE_2.
+    # Each report repeats the records of the `overlap` - 1 reports before it.
+    # Returns (filenames, rows) with the total number of rows in the reports
+    from config import WATCHLIST
+    from ingest import business_days, report_filename
+
+    end = datetime.date.today()
+    dates = business_days(end - datetime.timedelta(days=days * 2 + 7), end)[-days:]
+
+    watch_ids = [underlier for ids in WATCHLIST.values() for underlier in ids]
+    records = generate_records(
+        dates, rows_per_day, amend_rate, watch_share, watch_ids, seed
+    )
+
+    server_path = os.path.join(workdir, "server")
+    os.makedirs(server_path, exist_ok=True)
+
+    filenames = []
+    total_rows = 0
+
+    for day, date in enumerate(dates):
+        schema_name = ["PRE_2023", "PRE_PHASE_2", "PHASE_2"][day * 3 // days]
+        filename = report_filename(date)
+
+        with ZipFile(os.path.join(server_path, filename), "w", ZIP_DEFLATED) as zip_ref:
+            for member in range(max(0, day - overlap + 1), day + 1):
+                zip_ref.writestr(
+                    f"{filename[:-4]}_{member}.csv",
+                    report_csv(schema_name, records[member]),
+                )
+                total_rows += len(records[member]["id"])
+
+        filenames.append(filename)
+
+    return filenames, total_rows
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    # Serve `directory` over HTTP on a free local port, in a background thread.  Returns the server
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def prepare_stage(stage, url, filenames):
+    # Untimed setup of `stage`.  Returns (run, rows): the function to time and the rows it handles
+    import pyarrow.dataset as ds
+    import ingest
+    from config import PROCESSED_PATH, WATCHLIST
+    from extract import all_underlier_ids, extract_underliers
+    from fetcher import Fetcher
+    from lineage import IDENTIFIER_COLUMNS, coalesce_progenitors, find_parents
+    from processed import daily_reports, open_dataset, rebuild_processed
+    from underlier_index import narrow_dataset, update_index
+
+    if stage == "ingest":
+        # Fetch from the stand-in as fast as it answers
+        ingest.DTCC_REPORT_URL = url
+        ingest.fetcher = Fetcher(rate=10**6)
+
+        def run():
+            for filename in filenames:
+                ingest.download_and_filter(filename)
+
+        return run, None
+
+    if stage == "process":
+        rows = sum(
+            ds.dataset(path, format="parquet").count_rows()
+            for path in daily_reports().values()
+        )
+        return rebuild_processed, rows
+
+    dataset = open_dataset(PROCESSED_PATH)
+    underlier_ids = all_underlier_ids(WATCHLIST)
+
+    if stage == "locate":
+        return lambda: extract_underliers(dataset, WATCHLIST), dataset.count_rows()
+
+    index = update_index(PROCESSED_PATH)
+
+    if stage == "locate_indexed":
+        return (
+            lambda: extract_underliers(
+                narrow_dataset(dataset, index, underlier_ids), WATCHLIST
+            ),
+            dataset.count_rows(),
+        )
+
+    if stage == "find_parents":
+        underlier_swaps = extract_underliers(
+            narrow_dataset(dataset, index, underlier_ids), WATCHLIST
+        )
+
+        def run():
+            for swaps in underlier_swaps.values():
+                find_parents(swaps, dataset)
+
+        return run, dataset.count_rows()
+
+    if stage == "coalesce":
+        identifiers = dataset.to_table(columns=IDENTIFIER_COLUMNS)
+        return lambda: coalesce_progenitors(identifiers), identifiers.num_rows
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def run_stage(stage, workdir, url, filenames, rows):
+    # Runs in a fresh process: time one stage inside the work directory, whose relative paths
+    #  (./output, ./processed, ...) the pipeline's config points at
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    run, stage_rows = prepare_stage(stage, url, filenames)
+
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+
+    return {
+        "stage": stage,
+        "seconds": seconds,
+        "rows": stage_rows if stage_rows is not None else rows,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic reports"
+    )
+    parser.add_argument(
+        "--days", type=int, default=15, help="business days of reports"
+    )
+    parser.add_argument(
+        "--rows-per-day", type=int, default=20000, help="new records per day"
+    )
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        default=3,
+        help="days of records each cumulative report holds",
+    )
+    parser.add_argument(
+        "--amend-rate",
+        type=float,
+        default=0.4,
+        help="share of records that amend an earlier one",
+    )
+    parser.add_argument(
+        "--watch-share",
+        type=float,
+        default=0.05,
+        help="share of new swaps on a watchlist underlier",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument(
+        "--workdir", help="keep the generated data here instead of a temporary folder"
+    )
+    parser.add_argument("--json", help="also save the results to this file")
+    args = parser.parse_args()
+
+    temporary = None
+    if args.workdir is None:
+        temporary = tempfile.TemporaryDirectory(prefix="swaps-benchmark-")
+        args.workdir = temporary.name
+
+    workdir = os.path.abspath(args.workdir)
+    for folder in ("output", "processed"):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+
+    print("Generating reports...")
+    filenames, rows = write_reports(
+        workdir,
+        args.days,
+        args.rows_per_day,
+        args.overlap,
+        args.amend_rate,
+        args.watch_share,
+        args.seed,
+    )
+
+    server = serve(os.path.join(workdir, "server"))
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+
+    print(f"{'stage':<16}{'seconds':>10}{'rows/s':>14}{'peak RSS MB':>14}")
+
+    try:
+        for stage in args.stages:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, workdir, url, filenames, rows))
+
+            results.append(result)
+            print(
+                f"{stage:<16}{result['seconds']:>10.2f}"
+                f"{result['rows'] / max(result['seconds'], 1e-9):>14,.0f}"
+                f"{result['peak_rss_mb']:>14,.0f}"
+            )
+    finally:
+        server.shutdown()
+
+        if temporary is not None:
+            temporary.cleanup()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,94 @@ OUTPUT_PATH = r"./output"  # path to folder where you want filtered reports to s
 PROCESSED_PATH = (
     r"./processed"  # path to folder where you want processed reports to save
 )
-GME_SWAPS_PATH = r"./gme_swaps"  # path to folder where you want GME swaps to save
+UNDERLIER_SWAPS_PATH = (
+    r"./underlier_swaps"  # path to folder where the swaps of each ticker in WATCHLIST are saved
+)
+UNDERLIER_INDEX_PATH = (
+    r"./underlier_index.parquet"  # index of which processed row groups hold each underlier
+)
+GME_SWAPS_PATH = UNDERLIER_SWAPS_PATH + r"/Ticker=GME"  # the GME swaps within it
+
+# Tickers to extract swaps for, with the RIC / ISIN / CUSIP identifiers their underliers appear as
+WATCHLIST = {
+    "GME": ["GME.N", "GME.AX", "US36467W1099", "36467W109"],
+}
+
+MAX_WORKERS = 24  # number of threads to use for downloading reports
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # bytes read from the network at a time while spooling a report to disk
+CSV_BLOCK_SIZE = 16 << 20  # bytes of CSV parsed per record batch; bounds peak memory per worker
+
+DTCC_REPORT_URL = r"https://pddata.dtcc.com/ppd/api/report/cumulative/sec"  # point at a local server to test
+REQUESTS_PER_SECOND = 10  # combined request rate across all workers
+MAX_RETRIES = 5  # attempts per report before giving up
+REQUEST_TIMEOUT = 60  # seconds to wait for the server to respond
+REFRESH_EXISTING = False  # re-request reports already converted, downloading them only if they changed
+
+PARSE_WORKERS = None  # number of processes parsing downloaded reports (None = one per CPU)
+PARSE_QUEUE_SIZE = 8  # downloaded reports allowed to wait for a parse worker before downloads pause
+
+MANIFEST_PATH = r"./manifest.json"  # record of every report requested, so re-runs only fetch new dates
+MISSING_RETRY_DAYS = 7  # keep re-requesting dates with no report for this many days, in case it's published late
+HOLIDAYS = []  # extra non-business days to skip besides weekends, e.g. ["2024-12-25"]
+
+INCREMENTAL = True  # only add newly downloaded reports to the processed data instead of rewriting it
+COMPACT_MIN_ROWS = 500000  # processed files with fewer rows than this count as small
+COMPACT_MAX_SMALL_FILES = 30  # merge the small processed files into one per month once there are more than this many
+
+PROGENITOR_CACHE_PATH = (
+    r"./progenitor_cache.parquet"  # progenitors found by the last correlation, reused while the swaps are unchanged
+)
+CORRELATED_PATH = (
+    OUTPUT_PATH + r"/correlated_swaps"  # the swaps with their progenitors, written by correlate_swaps.py
+)
+EXPOSURE_PATH = (
+    OUTPUT_PATH + r"/exposure.parquet"  # daily open swaps and notional per underlier, written by exposure.py
+)
+LIFECYCLE_PATH = (
+    OUTPUT_PATH + r"/lifecycle.parquet"  # start, amendments and end of every swap, written by lifecycle.py
+)
+CURRENT_STATE_PATH = (
+    OUTPUT_PATH + r"/current_state.parquet"  # the latest event of every correlated swap
+)
+INTERVAL_INDEX_PATH = (
+    r"./interval_index.parquet"  # days each correlated swap was live, for as-of queries
+)
+CORRELATED_CSV = True  # also export the correlated swaps as a csv file next to the parquet dataset
+CSV_COMPRESSION = None  # compress exported csv files with "gzip" or "zstd" (None = plain text)
+CSV_MAX_PART_BYTES = None  # split exported csv files into parts of about this many bytes (None = one file)
 
-MAX_WORKERS = 24  # number of threads to use for downloading and filtering
+# Options for every parquet file written, passed to pyarrow's ParquetWriter.  Entries naming
+#  columns a file doesn't have are ignored for that file
+PARQUET_PROFILE = {
+    "compression": "zstd",
+    "compression_level": 6,
+    # Dictionary encode only the low-cardinality text columns
+    "use_dictionary": [
+        "Action type",
+        "Event type",
+        "Asset Class",
+        "Cleared",
+        "Product name",
+        "Notional currency-Leg 1",
+        "Notional currency-Leg 2",
+        "Settlement currency-Leg 1",
+        "Settlement currency-Leg 2",
+        "Price currency",
+        "Price unit of measure",
+        "Quantity unit of measure-Leg 1",
+        "Quantity unit of measure-Leg 2",
+        "Underlier ID source-Leg 1",
+        "Option Type",
+        "Option Style",
+        "Delivery Type",
+    ],
+    "data_page_size": 1 << 20,
+    "write_statistics": True,
+    "write_page_index": True,
+    # Only written by pyarrow versions that support bloom filters, and skipped on older ones
+    "bloom_filter_options": {
+        "Dissemination Identifier": {"ndv": 1 << 20, "fpp": 0.01},
+        "Underlier ID-Leg 1": {"ndv": 1 << 16, "fpp": 0.01},
+    },
+}
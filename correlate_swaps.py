@@ -1,167 +1,123 @@
 import pyarrow as pa
-import pyarrow.csv as csv
 import pyarrow.parquet as pq
 import pyarrow.dataset as ds
-import pyarrow.compute as pc
-import pandas as pd
-from tqdm import tqdm
+import numpy as np
+import os
 
 from config import (
     OUTPUT_PATH,
-    PROCESSED_PATH,
     GME_SWAPS_PATH,
-    MAX_WORKERS,
+    CORRELATED_PATH,
+    CORRELATED_CSV,
 )
-from schemas import CORRELATED_CUSTOM
+from csv_export import export_csv
+from current_state import update_current_state
+from lineage import IDENTIFIER_COLUMNS, coalesce_progenitors, id_array
+from processed import MIN_ROWS_PER_GROUP, open_dataset
+from progenitor_cache import (
+    added_fragments,
+    dataset_fingerprint,
+    load_cache,
+    save_cache,
+)
+from schemas import CORRELATED_CUSTOM, conform_to_schema
+from write_options import partial_path, writer_options
 
 # Load the swaps dataset
-dataset = ds.dataset(GME_SWAPS_PATH, format="parquet")
-
-# Load the swaps table
-identifiers = dataset.to_table(
-    columns=[
-        "Dissemination Identifier",
-        "Original Dissemination Identifier",
-        "Action type",
-    ]
-)
+dataset = open_dataset(GME_SWAPS_PATH)
+
+
+def correlate_batches(dataset, progenitors):
+    # The rows of `dataset` with their progenitor, conformed to CORRELATED_CUSTOM one record batch at a
+    #  time.  The progenitors are looked up by position (an m:1 join on "Dissemination Identifier"),
+    #  so the swaps are never held in memory all at once or converted to pandas.
+    # `progenitors` is sorted by "Dissemination Identifier" (see coalesce_progenitors), so each batch
+    #  is matched with a binary search rather than hashing every identifier again
+    ids = id_array(progenitors.column("Dissemination Identifier"))
+    progenitor_ids = progenitors.column(
+        "Progenitor Dissemination Identifier"
+    ).combine_chunks()
+
+    for batch in dataset.to_batches():
+        table = pa.Table.from_batches([batch])
+        batch_ids = id_array(table.column("Dissemination Identifier"))
+        positions = np.searchsorted(ids, batch_ids)
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == batch_ids[found]
+        table = table.append_column(
+            "Progenitor Dissemination Identifier",
+            progenitor_ids.take(pa.array(positions, mask=~found)),
+        )
 
-# Add a new column to the table called "Progenitor Dissemination Identifier"
-identifiers = identifiers.append_column(
-    pa.field("Progenitor Dissemination Identifier", pa.int64(), nullable=True),
-    pa.array([None] * identifiers.num_rows, type=pa.int64()),
+        # Selects the columns in CORRELATED_CUSTOM order, with the progenitor 3rd and "Report date"
+        #  (which isn't part of it) dropped
+        yield from conform_to_schema(table, CORRELATED_CUSTOM).to_batches()
+
+
+# Reuse the progenitors from the last run when the swaps haven't changed, and when swaps were only
+#  added, resolve just the added fragments on top of them
+fingerprint = dataset_fingerprint(dataset, GME_SWAPS_PATH)
+cached_progenitors, cached_fingerprint = load_cache()
+added = added_fragments(cached_fingerprint, fingerprint)
+
+if added is None:
+    print("Finding progenitors...")
+    progenitors = coalesce_progenitors(dataset.to_table(columns=IDENTIFIER_COLUMNS))
+elif len(added) > 0:
+    print(f"Finding progenitors in {len(added)} new files...")
+    new_identifiers = ds.dataset(
+        [os.path.join(GME_SWAPS_PATH, fragment) for fragment in added],
+        format="parquet",
+    ).to_table(columns=IDENTIFIER_COLUMNS)
+    progenitors = coalesce_progenitors(new_identifiers, known=cached_progenitors)
+else:
+    print("Swaps are unchanged, using cached progenitors")
+    progenitors = cached_progenitors
+
+if added is None or len(added) > 0:
+    save_cache(progenitors, fingerprint)
+
+print(progenitors)
+
+# Save the correlated swaps dataset, through a temporary file (see partial_path)
+os.makedirs(CORRELATED_PATH, exist_ok=True)
+parquet_filename = os.path.join(CORRELATED_PATH, "part-0.parquet")
+partial_filename = partial_path(parquet_filename)
+
+parquet_writer = pq.ParquetWriter(
+    partial_filename, CORRELATED_CUSTOM, **writer_options(CORRELATED_CUSTOM)
 )
 
-identifiers = identifiers.to_pandas()
-identifiers.drop_duplicates(inplace=True)
-
-# We can identify the progenitors by following the chain of "Original Dissemination Identifier" values
-# Since we have incomplete data, we can identify only the _true_ progenitors when there is a NEWT action.
-#   In other cases, we will simply use the earliest known transaction identifier as the progenitor.
-
-# For rows that have an action type of "NEWT" and a blank value in "Original Dissemination Identifier"
-#   copy the "Dissemination Identifier" value to the "Progenitor Dissemination Identifier" column
-identifiers.loc[
-    (identifiers["Original Dissemination Identifier"].isna())
-    & (identifiers["Action type"] == "NEWT"),
-    "Progenitor Dissemination Identifier",
-] = identifiers["Dissemination Identifier"]
-
-# Now, we can find "synthetic" progenitors by looking for records that have an "Original Dissemination Identifier" value
-#  that is not present in the "Dissemination Identifier" column
-# Copy the "Dissemination Identifier" value to the "Progenitor Dissemination Identifier" column
-#  for these synthetic progenitors
-identifiers.loc[
-    ~identifiers["Original Dissemination Identifier"].isin(
-        identifiers["Dissemination Identifier"]
-    ),
-    "Progenitor Dissemination Identifier",
-] = identifiers["Dissemination Identifier"]
-
-
-def coalesce_progenitors(table):
-    # For rows that have a value in "Original Dissemination Identifier" and a blank value in "Progenitor Dissemination Identifier"
-    #  copy the "Progenitor Dissemintion Identifier" value from the row that contains the "Original Dissemination Identifier" value
-    #  in the "Dissemination Identifier" column
-    # For example, if the "Original Dissemination Identifier" value is 12345, and the "Dissemination Identifier" value is 67890,
-    #  and the "Progenitor Dissemination Identifier" value is blank, copy the "Progenitor Dissemination Identifier" value from the row
-    #  that contains the "Dissemination Identifier" value of 12345
-    lacking_progenitors = table[
-        (table["Progenitor Dissemination Identifier"].isna())
-        & (table["Original Dissemination Identifier"].notna())
-    ]
-
-    total_lacking_count = len(lacking_progenitors)
-    print(total_lacking_count)
-
-    found_last_step = 0
-
-    # Set up a progress bar.  We know how many total progenitors are missing, but not how many we will find in each iteration
-    pbar = tqdm(
-        range(total_lacking_count),
-        desc="Coalescing progenitors",
-        miniters=None,
-        mininterval=0,
-        smoothing=0.01,
-        unit="rows",
-    )
+# The swaps dataset has a small fragment per report, and every write makes its own row group, so
+#  batches are gathered into row groups of MIN_ROWS_PER_GROUP rows before they're written
+pending = []
+
+for batch in correlate_batches(dataset, progenitors):
+    pending.append(batch)
 
-    while len(lacking_progenitors) > 0:
-        # pbar.set_postfix(
-        #     {
-        #         "Total missing progenitors": total_lacking_count,
-        #         "Current missing progenitors": last_lacking_count,
-        #     },
-        #     refresh=True,
-        # )
-        # Left join the table with itself on the "Dissemination Identifier" and "Original Dissemination Identifier" columns
-
-        table = table.merge(
-            table,
-            how="left",
-            left_on="Original Dissemination Identifier",
-            right_on="Dissemination Identifier",
-            suffixes=("", "_y"),
-            validate="m:1",
+    if sum(batch.num_rows for batch in pending) >= MIN_ROWS_PER_GROUP:
+        table = pa.Table.from_batches(pending, schema=CORRELATED_CUSTOM)
+        full = table.num_rows - table.num_rows % MIN_ROWS_PER_GROUP
+        parquet_writer.write_table(
+            table.slice(0, full), row_group_size=MIN_ROWS_PER_GROUP
         )
+        pending = table.slice(full).to_batches()
 
-        # Select "Dissemination Identifier" and "Original Dissemination Identifier" from the left table,
-        #  and "Progenitor Dissemination Identifier" from the right table if it is not null
-        table["Progenitor Dissemination Identifier"] = table[
-            "Progenitor Dissemination Identifier_y"
-        ].combine_first(table["Progenitor Dissemination Identifier"])
-
-        # Drop the "_y" columns
-        table = table[[col for col in table.columns if not col.endswith("_y")]]
-
-        lacking_progenitors = table[
-            (table["Progenitor Dissemination Identifier"].isna())
-            & (table["Original Dissemination Identifier"].notna())
-        ]
-
-        # Update the progress bar with the number of missing progenitors found in this iteration
-        pbar.update(total_lacking_count - len(lacking_progenitors) - found_last_step)
-        found_last_step = total_lacking_count - len(lacking_progenitors)
-
-    pbar.close()
-    return table
-
-
-identifiers = coalesce_progenitors(identifiers)
-print(identifiers)
-
-# Add the "Progenitor Dissemination Identifier" column to the dataset
-correlated_swaps = (
-    dataset.to_table()
-    .to_pandas()
-    .merge(
-        identifiers[
-            ["Dissemination Identifier", "Progenitor Dissemination Identifier"]
-        ],
-        how="left",
-        left_on="Dissemination Identifier",
-        right_on="Dissemination Identifier",
+if len(pending) > 0:
+    parquet_writer.write_table(
+        pa.Table.from_batches(pending, schema=CORRELATED_CUSTOM)
     )
-)
 
-# Move the progenitor column to the 3rd position
-correlated_swaps = correlated_swaps[
-    [
-        "Dissemination Identifier",
-        "Original Dissemination Identifier",
-        "Progenitor Dissemination Identifier",
-        "Action type",
-    ]
-    + [col for col in correlated_swaps.columns if col not in identifiers.columns]
-]
-
-# Save a csv file with the correlated swaps
-correlated_swaps.to_csv(OUTPUT_PATH + "/correlated_swaps.csv")
-
-# Save the correlated swaps dataset
-ds.write_dataset(
-    correlated_swaps,
-    base_dir=OUTPUT_PATH + "/correlated_swaps",
-    format="parquet",
-    schema=CORRELATED_CUSTOM,
-)
+parquet_writer.close()
+os.replace(partial_filename, parquet_filename)
+
+# Export a csv copy, streamed from the parquet dataset
+if CORRELATED_CSV:
+    csv_base = os.path.join(OUTPUT_PATH, "correlated_swaps")
+
+    for path in export_csv(CORRELATED_PATH, csv_base):
+        print(f"Exported {path}")
+
+# Refresh the current state of each swap, re-reading only the swaps with new events
+state, updated = update_current_state()
+print(f"Updated the current state of {updated} of {state.num_rows} swaps")
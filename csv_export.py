@@ -0,0 +1,108 @@
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import glob
+import os
+import re
+from config import CSV_COMPRESSION, CSV_MAX_PART_BYTES
+
+# File extension for each supported compression codec
+EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# Rows written between checks of a part's size
+ROWS_PER_WRITE = 1024
+
+
+class PartWriter:
+    # Writes record batches to "<base>.csv", or with `max_part_bytes` set, to "<base>-0.csv",
+    #  "<base>-1.csv", ... starting a new part (with its own header) once a part reaches that size on disk
+    def __init__(self, base, schema, compression=None, max_part_bytes=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unsupported csv compression: {compression}")
+
+        self.base = base
+        self.schema = schema
+        self.compression = compression
+        self.max_part_bytes = max_part_bytes
+        self.paths = []
+        self.file = None
+        self.stream = None
+        self.writer = None
+
+    def part_path(self):
+        part = "" if self.max_part_bytes is None else f"-{len(self.paths)}"
+        return f"{self.base}{part}.csv{EXTENSIONS[self.compression]}"
+
+    def open_part(self):
+        path = self.part_path()
+        self.paths.append(path)
+
+        self.file = pa.OSFile(path, "wb")
+        self.stream = (
+            pa.CompressedOutputStream(self.file, self.compression)
+            if self.compression
+            else self.file
+        )
+        self.writer = csv.CSVWriter(self.stream, self.schema)
+
+    def close_part(self):
+        self.writer.close()
+        # Closing the compressed stream also closes the file under it
+        self.stream.close()
+        self.writer = None
+
+    def write_batch(self, batch):
+        for offset in range(0, batch.num_rows, ROWS_PER_WRITE):
+            if self.writer is None:
+                self.open_part()
+
+            self.writer.write_batch(batch.slice(offset, ROWS_PER_WRITE))
+
+            # Compressed output is buffered before it reaches the file, so parts can run over the cap
+            if (
+                self.max_part_bytes is not None
+                and self.file.tell() >= self.max_part_bytes
+            ):
+                self.close_part()
+
+    def close(self):
+        if self.writer is not None:
+            self.close_part()
+
+        # Always leave at least a header behind
+        if len(self.paths) == 0:
+            self.open_part()
+            self.close_part()
+
+        return self.paths
+
+
+def export_csv(
+    source,
+    base,
+    compression=CSV_COMPRESSION,
+    max_part_bytes=CSV_MAX_PART_BYTES,
+):
+    # Stream the parquet dataset at `source` into csv file(s) named after `base` (a path without
+    #  extension), one record batch at a time, so the table is never held in memory.
+    # Returns the paths written
+    dataset = ds.dataset(source, format="parquet")
+
+    # Remove the parts of an earlier export, which may have been split differently, and nothing else:
+    #  only "<base>.csv" or "<base>-<n>.csv", with a compression extension
+    exported = re.compile(
+        re.escape(base)
+        + r"(-[0-9]+)?\.csv("
+        + "|".join(re.escape(extension) for extension in EXTENSIONS.values())
+        + ")"
+    )
+    for path in glob.glob(glob.escape(base) + "*.csv*"):
+        if exported.fullmatch(path):
+            os.remove(path)
+
+    writer = PartWriter(base, dataset.schema, compression, max_part_bytes)
+
+    for batch in dataset.to_batches():
+        writer.write_batch(batch)
+
+    return writer.close()
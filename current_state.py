@@ -0,0 +1,82 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import numpy as np
+import os
+from config import CORRELATED_PATH, CURRENT_STATE_PATH
+from exposure import load_events
+from lineage import id_array
+from schemas import CORRELATED_CUSTOM, conform_to_schema
+from write_options import write_table_atomic, writer_options
+
+# The current state of every correlated swap: the row of the last event in its progenitor's chain,
+#  keyed by "Progenitor" (the progenitor, or the row's own identifier when its chain loops)
+STATE_SCHEMA = pa.schema(
+    [pa.field("Progenitor", pa.int64())] + list(CORRELATED_CUSTOM)
+)
+
+# Enough to find each swap's last event without reading the wide columns
+KEY_COLUMNS = [
+    "Dissemination Identifier",
+    "Progenitor Dissemination Identifier",
+    "Event timestamp",
+    "Execution Timestamp",
+]
+
+
+def last_events(events):
+    # The last event of each progenitor in `events` (sorted as by load_events).  Each progenitor's
+    #  events are contiguous and in the order they happened, so this is a vectorized group-last
+    progenitors = id_array(events.column("Progenitor"))
+    last = np.append(progenitors[1:] != progenitors[:-1], True)[: len(progenitors)]
+
+    return events.filter(pa.array(last))
+
+
+def load_state(state_path=CURRENT_STATE_PATH):
+    if not os.path.exists(state_path):
+        return STATE_SCHEMA.empty_table()
+
+    return pq.read_table(state_path, schema=STATE_SCHEMA)
+
+
+def update_current_state(
+    correlated_path=CORRELATED_PATH, state_path=CURRENT_STATE_PATH
+):
+    # Bring the current state in line with the correlated swaps.  Only the key columns are scanned to
+    #  find each swap's last event; the full rows are read just for the swaps whose last event changed.
+    # Returns (state, updated) with the number of swaps that were added or changed
+    latest = last_events(load_events(correlated_path, columns=KEY_COLUMNS)).select(
+        ["Progenitor", "Dissemination Identifier", "Row"]
+    )
+    state = load_state(state_path)
+
+    # Swaps whose last event is still the one in the state keep their row as is
+    current = state.select(["Progenitor", "Dissemination Identifier"])
+    unchanged = latest.join(
+        current, keys=["Progenitor", "Dissemination Identifier"], join_type="left semi"
+    )
+    changed = latest.join(
+        current, keys=["Progenitor", "Dissemination Identifier"], join_type="left anti"
+    )
+
+    state = state.filter(
+        pc.is_in(state.column("Progenitor"), unchanged.column("Progenitor"))
+    )
+
+    if changed.num_rows > 0:
+        changed = changed.sort_by("Row")
+        rows = ds.dataset(correlated_path, format="parquet").take(changed.column("Row"))
+        rows = conform_to_schema(
+            rows.append_column("Progenitor", changed.column("Progenitor")), STATE_SCHEMA
+        )
+        state = pa.concat_tables([state, rows])
+
+    state = state.sort_by("Progenitor")
+
+    write_table_atomic(
+        state, state_path, **writer_options(STATE_SCHEMA, sorted_by=["Progenitor"])
+    )
+
+    return state, changed.num_rows
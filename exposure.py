@@ -0,0 +1,223 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import numpy as np
+from config import CORRELATED_PATH, EXPOSURE_PATH
+from lineage import id_array
+from extract import normalize_underliers
+from write_options import write_table_atomic, writer_options
+
+# Actions after which a swap is no longer outstanding
+CLOSING_ACTIONS = ["TERM", "EROR"]
+
+# Stands in for a missing expiration date / a version that is never superseded
+OPEN_ENDED = np.iinfo(np.int32).max
+
+EVENT_COLUMNS = [
+    "Dissemination Identifier",
+    "Progenitor Dissemination Identifier",
+    "Action type",
+    "Event timestamp",
+    "Execution Timestamp",
+    "Effective Date",
+    "Expiration Date",
+    "Underlier ID-Leg 1",
+    "Notional currency-Leg 1",
+    "Notional amount-Leg 1 value",
+    "Notional amount-Leg 1 capped",
+]
+
+# The daily open positions written to EXPOSURE_PATH, one row per underlier, currency and day with any
+#  swaps open.  Capped notionals only count for their cap, so "Capped swaps" tells how many of the
+#  open swaps are under-counted
+EXPOSURE_SCHEMA = pa.schema(
+    [
+        pa.field("Underlier", pa.string()),
+        pa.field("Notional currency", pa.string()),
+        pa.field("Date", pa.date32()),
+        pa.field("Open swaps", pa.int64()),
+        pa.field("Open notional", pa.float64()),
+        pa.field("Capped swaps", pa.int64()),
+    ]
+)
+
+
+def day_numbers(column, fill):
+    # Days since 1970-01-01 of a date or timestamp column, with nulls as `fill`
+    if pa.types.is_timestamp(column.type):
+        column = column.cast(pa.timestamp("s")).cast(pa.date32())
+
+    return pc.fill_null(column.cast(pa.date32()).cast(pa.int32()), fill).to_numpy()
+
+
+def load_events(path=CORRELATED_PATH, columns=EVENT_COLUMNS, filter=None):
+    # The correlated swaps, sorted into each progenitor's events in the order they happened, with
+    #  "Row" (the row's position in the dataset), "Progenitor" (the swap a row belongs to) and
+    #  "Event date" columns added.
+    # Rows whose chain loops have no progenitor and are treated as a swap of their own
+    table = ds.dataset(path, format="parquet").to_table(columns=columns)
+    table = table.append_column(
+        "Row", pa.array(np.arange(table.num_rows, dtype=np.int64))
+    )
+
+    if filter is not None:
+        table = table.filter(filter)
+
+    table = table.append_column(
+        "Progenitor",
+        pc.coalesce(
+            table.column("Progenitor Dissemination Identifier"),
+            table.column("Dissemination Identifier"),
+        ),
+    )
+    table = table.append_column(
+        "Event date",
+        pc.coalesce(
+            table.column("Event timestamp"), table.column("Execution Timestamp")
+        )
+        .cast(pa.timestamp("s"))
+        .cast(pa.date32()),
+    )
+
+    return table.filter(pc.is_valid(table.column("Event date"))).sort_by(
+        [
+            ("Progenitor", "ascending"),
+            ("Event timestamp", "ascending"),
+            ("Dissemination Identifier", "ascending"),
+        ]
+    )
+
+
+def live_spans(events):
+    # The days each event's version of its swap was outstanding, as (start, end) day numbers with
+    #  `end` exclusive.  A version is live from its event (or the swap's effective date, if later)
+    #  until the swap's next event or its expiration date, whichever comes first.  Closing actions
+    #  leave an empty span, so the swap stops being outstanding on the day it's terminated
+    progenitors = id_array(events.column("Progenitor"))
+    event_days = day_numbers(events.column("Event date"), OPEN_ENDED)
+    effective = day_numbers(events.column("Effective Date"), np.iinfo(np.int32).min)
+    expiration = day_numbers(events.column("Expiration Date"), OPEN_ENDED - 1)
+
+    # Events are sorted by progenitor, so the next row is the next event of the same swap, if any
+    superseded = np.append(event_days[1:], OPEN_ENDED)
+    superseded[np.append(progenitors[1:] != progenitors[:-1], True)] = OPEN_ENDED
+
+    start = np.maximum(event_days, effective)
+    end = np.minimum(superseded, expiration + 1)
+
+    closing = pc.is_in(events.column("Action type"), pa.array(CLOSING_ACTIONS))
+    closing = pc.fill_null(closing, False).to_numpy()
+    end = np.where(closing, start, np.maximum(start, end))
+
+    return start, end
+
+
+def group_codes(*columns):
+    # A code per row for each distinct combination of `columns` (nulls count as ""), and the table of
+    #  distinct combinations the codes index into
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    dictionaries = []
+
+    for column in columns:
+        encoded = pc.fill_null(column, "").combine_chunks().dictionary_encode()
+        dictionaries.append(encoded.dictionary)
+        codes = codes * len(encoded.dictionary) + encoded.indices.to_numpy()
+
+    unique, codes = np.unique(codes, return_inverse=True)
+
+    # Decode each combination back into its column values
+    values = []
+    for dictionary in reversed(dictionaries):
+        values.append(dictionary.take(pa.array(unique % len(dictionary))))
+        unique = unique // len(dictionary)
+
+    return codes, values[::-1]
+
+
+def exposure_series(events, first_day=None, last_day=None):
+    # Open swaps and notional per underlier, currency and day from `first_day` to `last_day` (day
+    #  numbers; by default the span of the events).  Each live span adds its swap on its start day and
+    #  removes it on its end day, so one cumulative sum per group gives every day's totals without
+    #  replaying the events
+    start, end = live_spans(events)
+    live = start < end
+
+    event_days = day_numbers(events.column("Event date"), OPEN_ENDED)
+    if first_day is None:
+        first_day = int(start[live].min()) if live.any() else 0
+    if last_day is None:
+        last_day = int(event_days.max()) if len(event_days) else first_day
+
+    start = np.clip(start, first_day, last_day + 1)
+    end = np.clip(end, first_day, last_day + 1)
+    live = start < end
+
+    events = events.filter(pa.array(live))
+    start, end = start[live] - first_day, end[live] - first_day
+
+    codes, (underliers, currencies) = group_codes(
+        normalize_underliers(events.column("Underlier ID-Leg 1")),
+        events.column("Notional currency-Leg 1"),
+    )
+
+    days = last_day - first_day + 1
+    size = len(underliers) * (days + 1)
+    opened = codes * (days + 1) + start
+    closed = codes * (days + 1) + end
+
+    def daily_totals(weights=None):
+        changes = np.bincount(opened, weights, minlength=size)
+        changes = changes - np.bincount(closed, weights, minlength=size)
+
+        return changes.reshape(len(underliers), days + 1)[:, :days].cumsum(axis=1)
+
+    notional = np.nan_to_num(
+        pc.fill_null(events.column("Notional amount-Leg 1 value"), 0.0).to_numpy()
+    )
+    capped = pc.fill_null(events.column("Notional amount-Leg 1 capped"), False)
+
+    open_swaps = np.rint(daily_totals()).astype(np.int64)
+    open_notional = daily_totals(notional)
+    capped_swaps = np.rint(daily_totals(capped.to_numpy())).astype(np.int64)
+
+    # Only keep the days each group has anything open
+    group, day = np.nonzero(open_swaps)
+
+    return pa.table(
+        [
+            underliers.take(pa.array(group)),
+            currencies.take(pa.array(group)),
+            pa.array(day + first_day, pa.int32()).cast(pa.date32()),
+            pa.array(open_swaps[group, day]),
+            pa.array(open_notional[group, day]),
+            pa.array(capped_swaps[group, day]),
+        ],
+        schema=EXPOSURE_SCHEMA,
+    ).sort_by(
+        [
+            ("Underlier", "ascending"),
+            ("Notional currency", "ascending"),
+            ("Date", "ascending"),
+        ]
+    )
+
+
+def write_exposure(series, path=EXPOSURE_PATH):
+    write_table_atomic(
+        series,
+        path,
+        **writer_options(
+            EXPOSURE_SCHEMA, sorted_by=["Underlier", "Notional currency", "Date"]
+        ),
+    )
+
+
+if __name__ == "__main__":
+    print("Loading correlated swaps...")
+    events = load_events()
+
+    print("Building the exposure series...")
+    series = exposure_series(events)
+    write_exposure(series)
+
+    print(f"Wrote {series.num_rows} rows to {EXPOSURE_PATH}")
@@ -0,0 +1,52 @@
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import re
+
+
+def underlier_pattern(underlier_ids):
+    # A single regex matching any of the ids as a substring
+    return "|".join(re.escape(underlier_id) for underlier_id in underlier_ids)
+
+
+def normalize_underliers(underliers):
+    # Underliers are matched trimmed and upper-cased, so padded or lower-case variants are found too.
+    #  Works on columns and on dataset field expressions alike
+    return pc.utf8_upper(pc.utf8_trim_whitespace(underliers))
+
+
+def normalized_pattern(underlier_ids):
+    return underlier_pattern(
+        [underlier_id.strip().upper() for underlier_id in underlier_ids]
+    )
+
+
+def underlier_filter(underlier_ids):
+    # Filter on "Underlier ID-Leg 1" that the scanner evaluates while reading, instead of us
+    #  combining masks batch by batch
+    return pc.match_substring_regex(
+        normalize_underliers(ds.field("Underlier ID-Leg 1")),
+        normalized_pattern(underlier_ids),
+    )
+
+
+def all_underlier_ids(watchlist):
+    return [underlier_id for ids in watchlist.values() for underlier_id in ids]
+
+
+def extract_underliers(dataset, watchlist):
+    # Split out the swaps of every ticker in `watchlist` (ticker -> RIC / ISIN / CUSIP ids) with one
+    #  multi-threaded scan of `dataset`, whatever the number of tickers.
+    # Returns {ticker: table}; a row whose underlier matches several tickers is in each of their tables
+    matches = dataset.to_table(
+        filter=underlier_filter(all_underlier_ids(watchlist)), use_threads=True
+    )
+
+    # Tagging the matches by ticker only touches the (small) matching rows
+    underliers = normalize_underliers(matches.column("Underlier ID-Leg 1"))
+
+    return {
+        ticker: matches.filter(
+            pc.match_substring_regex(underliers, normalized_pattern(ids))
+        )
+        for ticker, ids in watchlist.items()
+    }
@@ -0,0 +1,153 @@
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    MAX_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    REQUESTS_PER_SECOND,
+    MAX_RETRIES,
+    REQUEST_TIMEOUT,
+)
+
+# Status codes worth retrying; everything else (e.g. 404 for a day without a report) is final
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    # Shared between all worker threads so the combined request rate stays under `rate` per second,
+    #  with bursts of up to `capacity` requests
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Stop handing out tokens to every thread, e.g. when the server asks us to back off
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(
+                        self.capacity, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff(attempt):
+    return 2**attempt + random.random()
+
+
+class Fetcher:
+    def __init__(
+        self,
+        pool_size=MAX_WORKERS,
+        rate=REQUESTS_PER_SECOND,
+        max_retries=MAX_RETRIES,
+        timeout=REQUEST_TIMEOUT,
+    ):
+        # One keep-alive connection per worker, reused across every report we download
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.bucket = TokenBucket(rate, pool_size)
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def fetch(self, url, out, validators=None):
+        # Stream `url` into the file object `out`.
+        # `validators` holds the "ETag"/"Last-Modified" of a copy we already have; if the server
+        #  reports it unchanged the status is 304 and `out` is left untouched.
+        # Returns (status, validators), with status None if every attempt failed.
+        headers = {}
+        if validators:
+            if validators.get("ETag"):
+                headers["If-None-Match"] = validators["ETag"]
+            if validators.get("Last-Modified"):
+                headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        for attempt in range(self.max_retries):
+            self.bucket.acquire()
+
+            try:
+                with self.session.get(
+                    url, headers=headers, stream=True, timeout=self.timeout
+                ) as response:
+                    if response.status_code in RETRY_STATUSES:
+                        delay = parse_retry_after(response.headers.get("Retry-After"))
+                        print(
+                            f"Got {response.status_code} for {url} on try {attempt + 1}"
+                        )
+
+                        if response.status_code == 429 or delay is not None:
+                            # The server is throttling us, so hold back every worker, not just this one
+                            self.bucket.pause(delay if delay is not None else backoff(attempt))
+                        else:
+                            time.sleep(backoff(attempt))
+
+                        continue
+
+                    if response.status_code != 200:
+                        return response.status_code, validators
+
+                    out.seek(0)
+                    out.truncate()
+
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        out.write(chunk)
+
+                    return 200, {
+                        name: response.headers[name]
+                        for name in ("ETag", "Last-Modified")
+                        if name in response.headers
+                    }
+            except requests.RequestException as e:
+                print(f"Failed to fetch {url} on try {attempt + 1}: {e}")
+                time.sleep(backoff(attempt))
+
+        print(f"Failed to fetch {url} after {self.max_retries} tries")
+        return None, validators
@@ -0,0 +1,366 @@
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+import os
+import io
+import asyncio
+import datetime
+import tempfile
+import numpy as np
+from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tqdm import tqdm
+from config import (
+    OUTPUT_PATH,
+    MAX_WORKERS,
+    PARSE_WORKERS,
+    PARSE_QUEUE_SIZE,
+    CSV_BLOCK_SIZE,
+    DTCC_REPORT_URL,
+    REFRESH_EXISTING,
+    MANIFEST_PATH,
+    MISSING_RETRY_DAYS,
+    HOLIDAYS,
+)
+from fetcher import Fetcher
+from manifest import Manifest
+from schemas import (
+    CONVERTED,
+    PHASE_2,
+    add_amounts,
+    column_mapping,
+    identify_schema,
+    map_columns,
+)
+from write_options import file_checksum, partial_path, writer_options
+
+fetcher = Fetcher(pool_size=MAX_WORKERS)
+
+REPORT_PREFIX = "SEC_CUMULATIVE_EQUITIES_"
+
+
+def report_filename(date):
+    return f"{REPORT_PREFIX}{date.strftime('%Y_%m_%d')}.zip"
+
+
+def report_date(filename):
+    # SEC_CUMULATIVE_EQUITIES_YYYY_MM_DD.zip (or .parquet) -> date
+    stem = os.path.basename(filename)[len(REPORT_PREFIX) :].split(".")[0]
+    return datetime.datetime.strptime(stem, "%Y_%m_%d").date()
+
+
+def business_days(start, end):
+    # Every weekday from start to end inclusive, less HOLIDAYS; DTCC doesn't publish on the rest
+    days = np.arange(
+        np.datetime64(start, "D"), np.datetime64(end, "D") + 1, dtype="datetime64[D]"
+    )
+    days = days[np.is_busday(days, holidays=HOLIDAYS)]
+
+    return days.astype(datetime.date).tolist()
+
+
+def pending_reports(filenames, manifest, today=None):
+    # Drop reports that we've already converted, and dates DTCC has confirmed it has no report for.
+    # Recent missing dates are retried for MISSING_RETRY_DAYS in case the report is published late
+    today = today or datetime.date.today()
+    pending = []
+
+    for filename in filenames:
+        entry = manifest.get(filename) or {}
+        parquet_filename = os.path.join(
+            OUTPUT_PATH, filename.replace(".zip", ".parquet")
+        )
+
+        if entry.get("status") == "complete" and not REFRESH_EXISTING:
+            if os.path.exists(parquet_filename):
+                continue
+        elif entry.get("status") == "missing":
+            if (today - report_date(filename)).days > MISSING_RETRY_DAYS:
+                continue
+
+        pending.append(filename)
+
+    return pending
+
+
+def invalid_row_handler(row):
+    print("Failed to parse the following row:")
+    print(row)
+    return "skip"
+
+
+parse_options = csv.ParseOptions(invalid_row_handler=invalid_row_handler)
+read_options = csv.ReadOptions(block_size=CSV_BLOCK_SIZE)
+
+
+def read_header(zip_ref, file):
+    with zip_ref.open(file) as f:
+        line = f.readline()
+
+    # Let pyarrow parse the header line on its own so quoting is handled the same way
+    return csv.read_csv(io.BytesIO(line)).column_names
+
+
+def csv_options(column_names):
+    schema = identify_schema(column_names)
+
+    if schema is None:
+        print(f"Unrecognised report layout, inferring column types: {column_names}")
+        return read_options, csv.ConvertOptions()
+
+    mapping = column_mapping(schema)
+
+    # Rename to PHASE_2 names while reading.  A column with no PHASE_2 equivalent, or one that maps
+    #  onto a name already claimed by an earlier column, keeps its source name
+    names = []
+    for name in column_names:
+        target = mapping.get(name, name)
+        names.append(target if target is not None and target not in names else name)
+
+    column_types = {}
+    for source, name in zip(column_names, names):
+        if source not in schema.names:
+            continue
+
+        # Parse straight into the PHASE_2 type.  The report's own type is kept for columns with no
+        #  PHASE_2 equivalent and for timestamps without a zone, which are cast to UTC afterwards
+        column_type = schema.field(source).type
+        if name in PHASE_2.names and not (
+            pa.types.is_timestamp(column_type) and column_type.tz is None
+        ):
+            column_type = PHASE_2.field(name).type
+
+        column_types[name] = column_type
+
+    # Skip converting columns that won't make it into the PHASE_2 output
+    include_columns = [
+        name
+        for source, name in zip(column_names, names)
+        if name in PHASE_2.names or mapping.get(source) is not None
+    ]
+
+    return (
+        csv.ReadOptions(block_size=CSV_BLOCK_SIZE, column_names=names, skip_rows=1),
+        csv.ConvertOptions(column_types=column_types, include_columns=include_columns),
+    )
+
+
+def source_validators(parquet_filename):
+    # The ETag / Last-Modified of the report a parquet file was converted from, if the server sent them
+    metadata = pq.read_schema(parquet_filename).metadata or {}
+
+    return {
+        name: metadata[name.encode()].decode()
+        for name in ("ETag", "Last-Modified")
+        if name.encode() in metadata
+    }
+
+
+def download_report(filename):
+    # Network stage: fetch a report into a temporary zip file.
+    # Returns (entry, report): the manifest entry describing the attempt (None if no request was made)
+    #  and (zip_path, parquet_filename, validators) when there is something to convert
+    parquet_filename = os.path.join(OUTPUT_PATH, filename.replace(".zip", ".parquet"))
+    validators = None
+
+    # Download the zip file if it's not present in the staging directory
+    if os.path.exists(parquet_filename):
+        if not REFRESH_EXISTING:
+            return None, None
+
+        # Only download it again if the server has a newer copy
+        validators = source_validators(parquet_filename)
+
+    url = f"{DTCC_REPORT_URL}/{filename}"
+    entry = {
+        "date": report_date(filename).isoformat(),
+        "url": url,
+        "fetched_at": datetime.datetime.now(datetime.timezone.utc).isoformat(
+            timespec="seconds"
+        ),
+    }
+
+    # Stream the response to disk so we never hold the whole zip in memory
+    spool = tempfile.NamedTemporaryFile(suffix=".zip", delete=False)
+
+    try:
+        with spool:
+            status, validators = fetcher.fetch(url, spool, validators)
+    except BaseException:
+        os.remove(spool.name)
+        raise
+
+    if status != 200:
+        os.remove(spool.name)
+
+        if status == 304:
+            entry["status"] = "complete"
+        elif status == 404:
+            entry["status"] = "missing"
+        else:
+            print(f"Failed to download {url}")
+            entry["status"] = "failed"
+
+        return entry, None
+
+    entry["status"] = "downloaded"
+    entry["size"] = os.path.getsize(spool.name)
+    entry["checksum"] = file_checksum(spool.name)
+
+    return entry, (spool.name, parquet_filename, validators)
+
+
+def convert_report(zip_path, parquet_filename, validators=None):
+    # CPU stage: parse every CSV member of a downloaded zip into one CONVERTED parquet file: the PHASE_2
+    #  columns, plus the amounts parsed into numbers
+
+    partial_filename = partial_path(parquet_filename)
+
+    # Every member is written through one writer with the unified schema, batch by batch
+    writer = pq.ParquetWriter(
+        partial_filename,
+        CONVERTED.with_metadata(validators or None),
+        **writer_options(CONVERTED),
+    )
+
+    try:
+        try:
+            with ZipFile(zip_path) as zip_ref:
+                for file in zip_ref.namelist():
+                    member_read_options, convert_options = csv_options(
+                        read_header(zip_ref, file)
+                    )
+
+                    # Read the member in blocks of CSV_BLOCK_SIZE and write each one out as it's
+                    #  parsed
+                    reader = csv.open_csv(
+                        zip_ref.open(file),
+                        read_options=member_read_options,
+                        parse_options=parse_options,
+                        convert_options=convert_options,
+                    )
+
+                    for batch in reader:
+                        writer.write_table(
+                            add_amounts(map_columns(pa.Table.from_batches([batch])))
+                        )
+        finally:
+            writer.close()
+    except BaseException:
+        # Don't leave the half written file behind
+        os.remove(partial_filename)
+        raise
+
+    os.replace(partial_filename, parquet_filename)
+
+
+def download_and_filter(filename):
+    # Download and convert a single report in the calling thread, returning its manifest entry
+    entry, report = download_report(filename)
+
+    if report is None:
+        return entry
+
+    try:
+        convert_report(*report)
+    finally:
+        os.remove(report[0])
+
+    entry["status"] = "complete"
+    entry["processed"] = None
+    return entry
+
+
+async def download_and_filter_all(
+    filenames,
+    fetch_workers=MAX_WORKERS,
+    parse_workers=PARSE_WORKERS,
+    queue_size=PARSE_QUEUE_SIZE,
+    manifest_path=MANIFEST_PATH,
+):
+    # Downloads run on a thread pool with at most `fetch_workers` in flight, and completed zips are
+    #  handed through a bounded queue to a process pool that parses and writes them.  A download keeps
+    #  its slot until the queue accepts its zip, so when parsing falls behind, fetching waits for it.
+    # Only reports the manifest doesn't already account for are requested
+    manifest = Manifest(manifest_path)
+    filenames = pending_reports(filenames, manifest)
+
+    parse_workers = parse_workers or os.cpu_count()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    fetch_slots = asyncio.Semaphore(fetch_workers)
+    pbar = tqdm(total=len(filenames))
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as io_pool, ProcessPoolExecutor(
+        max_workers=parse_workers
+    ) as cpu_pool:
+
+        async def fetch(filename):
+            async with fetch_slots:
+                entry, report = await loop.run_in_executor(
+                    io_pool, download_report, filename
+                )
+
+                if entry is not None:
+                    manifest.update(filename, entry)
+
+                if report is None:
+                    pbar.update(1)
+                    return
+
+                try:
+                    await queue.put((filename, report))
+                except BaseException:
+                    # Cancelled because a parser failed; nothing will convert this zip
+                    os.remove(report[0])
+                    raise
+
+        async def parse():
+            while True:
+                item = await queue.get()
+
+                if item is None:
+                    return
+
+                filename, report = item
+
+                try:
+                    await loop.run_in_executor(cpu_pool, convert_report, *report)
+                except Exception:
+                    manifest.update(filename, {"status": "failed"})
+                    raise
+                finally:
+                    os.remove(report[0])
+
+                # The new content isn't in the processed data yet
+                manifest.update(filename, {"status": "complete", "processed": None})
+                manifest.save()
+                pbar.update(1)
+
+        async def produce():
+            await asyncio.gather(*[fetch(filename) for filename in filenames])
+
+            for _ in parsers:
+                await queue.put(None)
+
+        parsers = [asyncio.create_task(parse()) for _ in range(parse_workers)]
+        producer = asyncio.create_task(produce())
+        tasks = [producer] + parsers
+
+        try:
+            # Parsers only finish early by failing, and then nothing would drain the queue the
+            #  downloads are waiting on, so stop at the first failure from either side
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            # Drop the queued conversions rather than running them after a failure
+            cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+            manifest.save()
+            pbar.close()
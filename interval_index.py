@@ -0,0 +1,125 @@
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import numpy as np
+import datetime
+import json
+import os
+from config import CORRELATED_PATH, INTERVAL_INDEX_PATH
+from exposure import load_events, live_spans
+from write_options import write_table_atomic
+
+# One row per version of each correlated swap that was ever outstanding: the days it was live, as
+#  "Start" to "End" (exclusive), and where its row is in the correlated dataset.  Rows are sorted by
+#  "Start", so the versions that started by a given day are a prefix of the index
+INDEX_SCHEMA = pa.schema(
+    [
+        pa.field("Start", pa.date32()),
+        pa.field("End", pa.date32()),
+        pa.field("Row", pa.int64()),
+        pa.field("Dissemination Identifier", pa.int64()),
+        pa.field("Progenitor", pa.int64()),
+    ]
+)
+
+# The index is stored with the mtime of each correlated fragment it was built from, by path relative
+#  to the correlated dataset, and rebuilt when they change
+FRAGMENTS_KEY = b"fragments"
+
+# Open ended spans are stored as ending on this day
+END_OF_TIME = datetime.date(9999, 12, 31)
+
+
+def correlated_fragments(correlated_path=CORRELATED_PATH):
+    return {
+        os.path.relpath(fragment.path, correlated_path): os.stat(
+            fragment.path
+        ).st_mtime_ns
+        for fragment in ds.dataset(correlated_path, format="parquet").get_fragments()
+    }
+
+
+def build_interval_index(events):
+    # The interval index of `events` (as returned by load_events)
+    start, end = live_spans(events)
+    live = start < end
+
+    # Cap open ended spans so they fit in a date32
+    end = np.minimum(end, (END_OF_TIME - datetime.date(1970, 1, 1)).days)
+
+    index = pa.table(
+        [
+            pa.array(start[live], pa.int32()).cast(pa.date32()),
+            pa.array(end[live], pa.int32()).cast(pa.date32()),
+            events.column("Row").filter(pa.array(live)),
+            events.column("Dissemination Identifier").filter(pa.array(live)),
+            events.column("Progenitor").filter(pa.array(live)),
+        ],
+        schema=INDEX_SCHEMA,
+    )
+
+    return index.sort_by([("Start", "ascending"), ("Row", "ascending")])
+
+
+def update_interval_index(
+    correlated_path=CORRELATED_PATH, index_path=INTERVAL_INDEX_PATH
+):
+    # The interval index of the correlated swaps, rebuilt first if they changed since it was written
+    fragments = correlated_fragments(correlated_path)
+
+    if os.path.exists(index_path):
+        index = pq.read_table(index_path)
+        metadata = index.schema.metadata or {}
+
+        if json.loads(metadata.get(FRAGMENTS_KEY, b"{}")) == fragments:
+            return index.replace_schema_metadata(None)
+
+    index = build_interval_index(load_events(correlated_path))
+
+    write_table_atomic(
+        index.replace_schema_metadata(
+            {FRAGMENTS_KEY: json.dumps(fragments, sort_keys=True)}
+        ),
+        index_path,
+        compression="zstd",
+    )
+
+    return index
+
+
+class IntervalIndex:
+    # The interval index held as NumPy arrays, for answering many as-of queries
+    def __init__(self, index):
+        self.index = index
+        self.start = index.column("Start").cast(pa.int32()).to_numpy()
+        self.end = index.column("End").cast(pa.int32()).to_numpy()
+
+    def live_positions(self, as_of_date):
+        # Positions in the index of the versions live on `as_of_date`: a binary search finds the
+        #  versions that had started by then, and a vectorized comparison those that hadn't ended
+        day = (as_of_date - datetime.date(1970, 1, 1)).days
+        started = np.searchsorted(self.start, day, side="right")
+
+        return np.flatnonzero(self.end[:started] > day)
+
+    def live_swaps(self, as_of_date):
+        # The "Row" (in the correlated dataset), "Dissemination Identifier" and "Progenitor" of the
+        #  version of every swap that was live on `as_of_date`
+        return self.index.take(self.live_positions(as_of_date)).select(
+            ["Row", "Dissemination Identifier", "Progenitor"]
+        )
+
+
+def live_swaps(
+    as_of_date, correlated_path=CORRELATED_PATH, index_path=INTERVAL_INDEX_PATH
+):
+    # The swaps live on `as_of_date`, see IntervalIndex.live_swaps.  Loads (or builds) the index on
+    #  every call; hold an IntervalIndex to run many queries
+    return IntervalIndex(
+        update_interval_index(correlated_path, index_path)
+    ).live_swaps(as_of_date)
+
+
+def read_rows(rows, correlated_path=CORRELATED_PATH):
+    # The correlated swaps at positions `rows`, e.g. the "Row" column returned by live_swaps
+    return ds.dataset(correlated_path, format="parquet").take(pa.array(rows))
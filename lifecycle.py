@@ -0,0 +1,128 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+from config import CORRELATED_PATH, LIFECYCLE_PATH
+from exposure import load_events
+from extract import normalize_underliers
+from write_options import write_table_atomic, writer_options
+
+# Actions counted separately for each swap
+ACTIONS = ["NEWT", "MODI", "CORR", "TERM", "EROR"]
+
+LIFECYCLE_COLUMNS = [
+    "Dissemination Identifier",
+    "Progenitor Dissemination Identifier",
+    "Action type",
+    "Event timestamp",
+    "Execution Timestamp",
+    "Expiration Date",
+    "Underlier ID-Leg 1",
+    "Notional currency-Leg 1",
+    "Notional amount-Leg 1 value",
+]
+
+
+def build_lifecycle(events):
+    # One row per swap (see load_events for "Progenitor") summarizing its events: when it was first
+    #  and last seen, how many events of each action it had, when it was terminated, how long it lived
+    #  (until its termination, or its last event if it's still open), and its notional when it opened
+    #  and at its last event.
+    # Done in a single group_by; first / last need the events in order, so it runs single threaded
+    events = events.append_column(
+        "Event time",
+        pc.coalesce(events["Event timestamp"], events["Execution Timestamp"]),
+    )
+
+    columns = {
+        "Progenitor": events["Progenitor"],
+        "Event time": events["Event time"],
+        "Underlier ID-Leg 1": normalize_underliers(
+            events["Underlier ID-Leg 1"]
+        ),
+        "Notional currency-Leg 1": events["Notional currency-Leg 1"],
+        "Notional amount-Leg 1 value": events["Notional amount-Leg 1 value"],
+        "Expiration Date": events["Expiration Date"],
+        "Terminated": pc.if_else(
+            pc.equal(events["Action type"], "TERM"),
+            events["Event time"],
+            pa.scalar(None, events["Event time"].type),
+        ),
+    }
+    for action in ACTIONS:
+        columns[action] = pc.fill_null(
+            pc.equal(events["Action type"], action), False
+        ).cast(pa.int64())
+
+    # Values at the open / last event are taken from that event even when they're null there
+    as_of_event = pc.ScalarAggregateOptions(skip_nulls=False)
+
+    summary = (
+        pa.table(columns)
+        .group_by("Progenitor", use_threads=False)
+        .aggregate(
+            [
+                ("Event time", "min"),
+                ("Event time", "max"),
+                ("Event time", "count"),
+                ("Underlier ID-Leg 1", "first"),
+                ("Notional currency-Leg 1", "first", as_of_event),
+                ("Notional amount-Leg 1 value", "first", as_of_event),
+                ("Notional amount-Leg 1 value", "last", as_of_event),
+                ("Expiration Date", "last", as_of_event),
+                ("Terminated", "min"),
+            ]
+            + [(action, "sum") for action in ACTIONS]
+        )
+    )
+
+    first_seen = summary["Event time_min"]
+    last_seen = summary["Event time_max"]
+    terminated = summary["Terminated_min"]
+
+    return pa.table(
+        [
+            summary["Progenitor"],
+            summary["Underlier ID-Leg 1_first"],
+            summary["Notional currency-Leg 1_first"],
+            first_seen,
+            last_seen,
+            terminated,
+            summary["Expiration Date_last"],
+            pc.subtract(pc.coalesce(terminated, last_seen), first_seen),
+            summary["Event time_count"],
+        ]
+        + [summary[f"{action}_sum"] for action in ACTIONS]
+        + [
+            summary["Notional amount-Leg 1 value_first"],
+            summary["Notional amount-Leg 1 value_last"],
+        ],
+        names=[
+            "Progenitor",
+            "Underlier",
+            "Notional currency",
+            "First seen",
+            "Last seen",
+            "Terminated",
+            "Expiration Date",
+            "Lifetime",
+            "Events",
+        ]
+        + [f"{action} count" for action in ACTIONS]
+        + ["Notional at open", "Notional at close"],
+    ).sort_by("Progenitor")
+
+
+def write_lifecycle(lifecycle, path=LIFECYCLE_PATH):
+    write_table_atomic(
+        lifecycle, path, **writer_options(lifecycle.schema, sorted_by=["Progenitor"])
+    )
+
+
+if __name__ == "__main__":
+    print("Loading correlated swaps...")
+    events = load_events(CORRELATED_PATH, columns=LIFECYCLE_COLUMNS)
+
+    print("Building swap lifecycles...")
+    lifecycle = build_lifecycle(events)
+    write_lifecycle(lifecycle)
+
+    print(f"Wrote {lifecycle.num_rows} swaps to {LIFECYCLE_PATH}")
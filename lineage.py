@@ -0,0 +1,196 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# Marks a missing parent / root in the arrays below
+NO_ID = -1
+
+# The columns linking each swap record to the one it amends
+LINK_COLUMNS = ["Dissemination Identifier", "Original Dissemination Identifier"]
+
+# The columns progenitors are found from
+IDENTIFIER_COLUMNS = LINK_COLUMNS + ["Action type"]
+
+
+def id_array(column):
+    # int64 NumPy array of an identifier column, with nulls as NO_ID
+    return pc.fill_null(column, NO_ID).to_numpy()
+
+
+def parent_positions(ids, parent_ids):
+    # Position of each row's parent within `ids` (which must be sorted and unique), or the row's own
+    #  position when its parent is missing from `ids`
+    positions = np.arange(len(ids))
+
+    if len(ids) == 0:
+        return positions
+
+    found = np.searchsorted(ids, parent_ids)
+    found = np.minimum(found, len(ids) - 1)
+    has_parent = (parent_ids != NO_ID) & (ids[found] == parent_ids) & (found != positions)
+
+    return np.where(has_parent, found, positions)
+
+
+def jump_to_roots(parents):
+    # Pointer jumping: replace every row's parent with its grandparent until nothing changes.
+    # Each step doubles the distance covered, so chains of any depth resolve in O(log depth)
+    #  vectorized steps.  Returns (roots, cyclic); rows whose chain loops have no root, so they are
+    #  flagged in `cyclic` and given themselves as root
+    roots = parents
+    steps = 0
+    max_steps = int(np.ceil(np.log2(max(len(parents), 2)))) + 1
+
+    while steps < max_steps:
+        next_roots = roots[roots]
+
+        if np.array_equal(next_roots, roots):
+            break
+
+        roots = next_roots
+        steps += 1
+
+    # A true root is its own parent; anything else was reached by going around a loop
+    cyclic = parents[roots] != roots
+    roots = np.where(cyclic, np.arange(len(roots)), roots)
+
+    return roots, cyclic
+
+
+def unique_links(table):
+    # The "Dissemination Identifier" -> "Original Dissemination Identifier" links in `table`.
+    # Rows repeat across the cumulative reports, so only the first row of each identifier is kept.
+    # Returns (ids, parent_ids, rows): the sorted unique identifiers, their originals (NO_ID if none),
+    #  and the position in `table` of the row each was taken from
+    ids = id_array(table.column("Dissemination Identifier"))
+    parent_ids = id_array(table.column("Original Dissemination Identifier"))
+
+    rows = np.flatnonzero(ids != NO_ID)
+    ids, first = np.unique(ids[rows], return_index=True)
+    rows = rows[first]
+
+    return ids, parent_ids[rows], rows
+
+
+def missing_parents(ids, parent_ids, parents):
+    # Rows that name an original which isn't among `ids`, i.e. whose chain is cut short by missing data
+    return (parent_ids != NO_ID) & (ids[parents] != parent_ids)
+
+
+def build_lineage(table):
+    # Resolve the progenitor of every dissemination identifier in `table` (which needs "Dissemination
+    #  Identifier" and "Original Dissemination Identifier") in one pass.
+    # Returns (ids, root_ids, cyclic) as NumPy arrays: the sorted unique identifiers, the earliest known
+    #  identifier in each one's chain, and whether the chain loops
+    ids, parent_ids, _ = unique_links(table)
+
+    roots, cyclic = jump_to_roots(parent_positions(ids, parent_ids))
+
+    return ids, ids[roots], cyclic
+
+
+def lineage_members(lineage, seed_ids):
+    # Every identifier sharing a progenitor with one of `seed_ids`: their ancestors, and any other
+    #  amendments of the same swaps
+    ids, root_ids, _ = lineage
+    seed_ids = np.asarray(seed_ids, dtype=ids.dtype)
+
+    if len(ids) == 0:
+        return ids
+
+    positions = np.minimum(np.searchsorted(ids, seed_ids), len(ids) - 1)
+    seed_roots = root_ids[positions][ids[positions] == seed_ids]
+
+    return ids[np.isin(root_ids, seed_roots)]
+
+
+def find_parents(table, dataset, lineage=None):
+    # Add every other row of the swaps in `table`: their parents back to the progenitor, and the
+    #  progenitors' other amendments, resolved from the lineage in one vectorized pass
+    return find_all_parents({None: table}, dataset, lineage)[None]
+
+
+def find_all_parents(tables, dataset, lineage=None):
+    # find_parents for several tables at once ({key: table}, e.g. one per ticker), fetching the rows
+    #  they're missing from `dataset` in a single scan.
+    # Returns {key: table}
+    if lineage is None:
+        lineage = build_lineage(dataset.to_table(columns=LINK_COLUMNS))
+
+    missing = {}
+    for key, table in tables.items():
+        ids = id_array(table.column("Dissemination Identifier"))
+        members = lineage_members(lineage, ids)
+        missing[key] = members[~np.isin(members, ids)]
+
+    all_missing = np.unique(
+        np.concatenate([np.empty(0, np.int64)] + list(missing.values()))
+    )
+
+    if len(all_missing) == 0:
+        return dict(tables)
+
+    all_parents = dataset.to_table(
+        filter=ds.field("Dissemination Identifier").isin(pa.array(all_missing))
+    )
+    parent_ids = all_parents.column("Dissemination Identifier")
+
+    return {
+        key: pa.concat_tables(
+            [table, all_parents.filter(pc.is_in(parent_ids, pa.array(missing[key])))]
+        )
+        for key, table in tables.items()
+    }
+
+
+# We can identify the progenitors by following the chain of "Original Dissemination Identifier" values
+# Since we have incomplete data, we can identify only the _true_ progenitors when there is a NEWT action.
+#   In other cases, we will simply use the earliest known transaction identifier as the progenitor.
+
+
+def coalesce_progenitors(table, known=None):
+    # Add a "Progenitor Dissemination Identifier" column to `table`, keeping one row per identifier.
+    # Rows with a blank "Original Dissemination Identifier" (e.g. NEWT actions) are their own progenitor,
+    #  and so are "synthetic" progenitors, whose original isn't present in the data.
+    # Every other row takes the progenitor of its original; rather than joining the table with itself
+    #  once per generation, each row points at its parent's position and pointer jumping follows
+    #  all the chains at once.  Rows whose chain loops have no progenitor.
+    # `known` is an earlier result of this function (e.g. from the cache) to extend with the rows of
+    #  `table`: its rows point straight at their known progenitor, so only new chains are walked
+    if known is not None:
+        known_count = known.num_rows
+        table = pa.concat_tables(
+            [known.drop_columns("Progenitor Dissemination Identifier"), table]
+        )
+
+    ids, parent_ids, rows = unique_links(table)
+    parents = parent_positions(ids, parent_ids)
+    missing = missing_parents(ids, parent_ids, parents)
+
+    if known is not None:
+        # Known rows come first, so they are the ones kept for identifiers in both tables
+        progenitor_ids = np.full(len(ids), NO_ID)
+        is_known = rows < known_count
+        progenitor_ids[is_known] = id_array(
+            known.column("Progenitor Dissemination Identifier")
+        )[rows[is_known]]
+
+        # Progenitors themselves keep pointing at their original, in case it has turned up since
+        shortcut = (progenitor_ids != NO_ID) & (progenitor_ids != ids)
+        parents[shortcut] = np.searchsorted(ids, progenitor_ids[shortcut])
+
+    roots, cyclic = jump_to_roots(parents)
+
+    print(f"Found {missing.sum()} synthetic progenitors with a missing original")
+
+    if cyclic.any():
+        print(
+            f"Found {cyclic.sum()} identifiers whose chain of originals loops, "
+            "leaving their progenitor blank"
+        )
+
+    return table.take(rows).append_column(
+        pa.field("Progenitor Dissemination Identifier", pa.int64(), nullable=True),
+        pa.array(ids[roots], mask=cyclic),
+    )
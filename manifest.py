@@ -0,0 +1,33 @@
+import json
+import os
+from write_options import partial_path
+
+
+class Manifest:
+    # Persisted record of every report we have requested, keyed by report filename.
+    # Each entry holds the report date, url, status ("downloaded", "complete", "missing" or "failed"),
+    #  and for downloaded reports their size, sha256 checksum and the time they were fetched.
+    # "processed" names the batch that added the report to the processed data, and is cleared
+    #  whenever the report is converted again
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, filename):
+        return self.entries.get(filename)
+
+    def update(self, filename, entry):
+        # Merge so fields from earlier attempts (e.g. checksum of the last good download) are kept
+        self.entries.setdefault(filename, {}).update(entry)
+
+    def save(self):
+        partial = partial_path(self.path)
+
+        with open(partial, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        os.replace(partial, self.path)
@@ -0,0 +1,434 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import glob
+import os
+import datetime
+import numpy as np
+from collections import defaultdict
+from config import (
+    OUTPUT_PATH,
+    PROCESSED_PATH,
+    MANIFEST_PATH,
+    COMPACT_MIN_ROWS,
+    COMPACT_MAX_SMALL_FILES,
+)
+from ingest import REPORT_PREFIX, report_date
+from manifest import Manifest
+from schemas import CONVERTED, PROCESSED, add_amounts, amount_fields, conform_to_schema
+from write_options import file_options, write_table_atomic, writer_options
+
+# Row group / file sizes for the processed dataset
+MIN_ROWS_PER_GROUP = 500000
+MAX_ROWS_PER_FILE = 5 * 10**6
+
+# Processed data (and the underlier swaps taken from it) is laid out as
+#  "Report date=2024-05-02/Asset Class=EQ/<name>-<i>.parquet", so filters on either column skip
+#  whole directories.  compact_processed later merges a month's reports into
+#  "Report month=2024-05/Asset Class=EQ/compacted-<time>-0.parquet"
+PARTITIONING = ds.partitioning(
+    pa.schema([PROCESSED.field("Report date"), PROCESSED.field("Asset Class")]),
+    flavor="hive",
+)
+
+# Rows are sorted by this column within each file, so row group statistics on it are selective
+SORT_KEY = "Dissemination Identifier"
+
+# The reports are cumulative, so a record is repeated in every report after the one it first appeared
+#  in.  Only that first copy is kept in the processed data, with records told apart by these columns
+DEDUP_KEY = ["Dissemination Identifier", "Action type", "Event timestamp"]
+
+
+def open_dataset(path=PROCESSED_PATH):
+    return ds.dataset(
+        path, format="parquet", schema=PROCESSED, partitioning=PARTITIONING
+    )
+
+
+def write_partitioned(data, base_dir, basename_template):
+    # `data` must already be sorted by SORT_KEY within each report
+    file_schema = pa.schema(
+        [field for field in data.schema if field.name not in PARTITIONING.schema.names]
+    )
+
+    ds.write_dataset(
+        data,
+        base_dir=base_dir,
+        basename_template=basename_template,
+        format="parquet",
+        file_options=file_options(file_schema, sorted_by=[SORT_KEY]),
+        partitioning=PARTITIONING,
+        min_rows_per_group=MIN_ROWS_PER_GROUP,
+        max_rows_per_file=MAX_ROWS_PER_FILE,
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def daily_reports(output_path=OUTPUT_PATH):
+    # The converted daily reports, by report filename (.zip, as recorded in the manifest)
+    return {
+        os.path.basename(path).replace(".parquet", ".zip"): path
+        for path in sorted(
+            glob.glob(os.path.join(output_path, f"{REPORT_PREFIX}*.parquet"))
+        )
+    }
+
+
+def record_keys(table):
+    # The DEDUP_KEY columns of `table`, with nulls filled in so they compare equal
+    columns = []
+
+    for name in DEDUP_KEY:
+        column = table.column(name)
+
+        if pa.types.is_timestamp(column.type):
+            column = column.cast(pa.int64())
+
+        fill = "" if pa.types.is_string(column.type) else -1
+        columns.append(pc.fill_null(column, fill))
+
+    return pa.table(columns, names=DEDUP_KEY)
+
+
+class SeenKeys:
+    # The keys of the records seen so far, for telling which records of each report are new without
+    #  hashing every earlier key again per report.  Keys are held as NumPy arrays sorted by
+    #  "Dissemination Identifier", in runs: each report adds a run, which is merged with the one
+    #  before while that one is at most twice its size, so there are only O(log n) runs and each key
+    #  is merged O(log n) times
+    def __init__(self):
+        self.runs = []
+        # Action type -> number, so every part of the key compares as an integer
+        self.actions = {}
+
+    def encode(self, keys):
+        # (ids, timestamps, actions) int64 arrays of a table of record keys
+        actions = keys.column("Action type").combine_chunks().dictionary_encode()
+        codes = np.array(
+            [
+                self.actions.setdefault(action, len(self.actions))
+                for action in actions.dictionary.to_pylist()
+            ],
+            dtype=np.int64,
+        )
+
+        return (
+            keys.column("Dissemination Identifier").to_numpy(),
+            keys.column("Event timestamp").to_numpy(),
+            codes[actions.indices.to_numpy()],
+        )
+
+    def contains(self, ids, timestamps, actions):
+        # Whether each key has been seen: a binary search finds the seen keys with the same
+        #  identifier (rarely more than one), which are then compared on the rest of the key
+        found = np.zeros(len(ids), dtype=bool)
+
+        for run_ids, run_timestamps, run_actions in self.runs:
+            first = np.searchsorted(run_ids, ids, side="left")
+            counts = np.searchsorted(run_ids, ids, side="right") - first
+
+            keys = np.repeat(np.arange(len(ids)), counts)
+            candidates = np.arange(len(keys)) + np.repeat(
+                first - (np.cumsum(counts) - counts), counts
+            )
+            same = (run_timestamps[candidates] == timestamps[keys]) & (
+                run_actions[candidates] == actions[keys]
+            )
+            found[keys[same]] = True
+
+        return found
+
+    def add(self, ids, timestamps, actions):
+        if len(ids) == 0:
+            return
+
+        order = np.argsort(ids, kind="stable")
+        self.runs.append((ids[order], timestamps[order], actions[order]))
+
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            last = self.runs.pop()
+            previous = self.runs.pop()
+            merged = [np.concatenate(columns) for columns in zip(previous, last)]
+            order = np.argsort(merged[0], kind="stable")
+            self.runs.append(tuple(column[order] for column in merged))
+
+
+def processed_keys(processed_path=PROCESSED_PATH, ids=None):
+    # Keys of the records already in the processed dataset, as a SeenKeys.  With `ids` (the
+    #  dissemination identifiers about to be added), only records in their range can match, so the
+    #  rest are skipped by row group statistics instead of scanning all of history
+    seen = SeenKeys()
+
+    if not os.path.exists(processed_path):
+        return seen
+
+    filter = None
+    if ids is not None:
+        bounds = pc.min_max(ids)
+        identifier = ds.field("Dissemination Identifier")
+        filter = identifier.is_null() | (
+            (identifier >= bounds["min"]) & (identifier <= bounds["max"])
+        )
+
+    keys = open_dataset(processed_path).to_table(columns=DEDUP_KEY, filter=filter)
+    seen.add(*seen.encode(record_keys(keys)))
+
+    return seen
+
+
+def drop_seen(table, seen):
+    # The first row of each record in `table` that isn't in `seen` (a SeenKeys), in their original
+    #  order.  Their keys are added to `seen`
+    keys = record_keys(table)
+    first = (
+        keys.append_column("Row", pa.array(np.arange(table.num_rows, dtype=np.int64)))
+        .group_by(DEDUP_KEY, use_threads=False)
+        .aggregate([("Row", "min")])
+    )
+    rows = np.sort(first.column("Row_min").to_numpy())
+
+    ids, timestamps, actions = (key[rows] for key in seen.encode(keys))
+
+    new = ~seen.contains(ids, timestamps, actions)
+    seen.add(ids[new], timestamps[new], actions[new])
+
+    return table.take(rows[new])
+
+
+def report_tables(reports, seen=None):
+    # Each daily report sorted by SORT_KEY and tagged with its report date, one report at a time, as
+    #  (filename, table).  Records in `seen` (a SeenKeys) or in an earlier report are left out
+    if seen is None:
+        seen = SeenKeys()
+
+    duplicates = 0
+
+    for filename, path in reports.items():
+        table = ds.dataset(path, format="parquet").to_table()
+
+        # Reports converted before amounts were parsed at ingest are parsed here instead
+        if any(field.name not in table.column_names for field in amount_fields()):
+            table = add_amounts(table)
+
+        table = conform_to_schema(table, CONVERTED)
+        rows = table.num_rows
+
+        table = drop_seen(table.sort_by(SORT_KEY), seen)
+        duplicates += rows - table.num_rows
+
+        table = table.append_column(
+            PROCESSED.field("Report date"),
+            pa.repeat(pa.scalar(report_date(filename), pa.date32()), table.num_rows),
+        )
+
+        yield filename, table
+
+    print(f"Dropped {duplicates} records already in an earlier report")
+
+
+def write_fragments(reports, name, processed_path=PROCESSED_PATH, seen=None):
+    # Merge / Split the given daily reports into processed fragments named "<name>-<i>.parquet",
+    #  leaving out records in `seen`.
+    # Each report only fills its own "Report date" partitions, so it's written as soon as it's read;
+    #  write_dataset would otherwise hold every partition's rows until the end, as none of them reach
+    #  MIN_ROWS_PER_GROUP.  Names are unique per batch, so fragments from earlier batches are never
+    #  overwritten
+    for _, table in report_tables(reports, seen):
+        write_partitioned(table, processed_path, f"{name}-{{i}}.parquet")
+
+
+def rebuild_processed(processed_path=PROCESSED_PATH, manifest_path=MANIFEST_PATH):
+    # Rewrite the processed dataset from every daily report
+    reports = daily_reports()
+
+    for file in glob.glob(os.path.join(processed_path, "**", "*.parquet"), recursive=True):
+        os.remove(file)
+
+    if len(reports) == 0:
+        return
+
+    write_fragments(reports, "full", processed_path)
+
+    manifest = Manifest(manifest_path)
+    for filename in reports:
+        manifest.update(filename, {"processed": "full"})
+    manifest.save()
+
+
+def append_processed(processed_path=PROCESSED_PATH, manifest_path=MANIFEST_PATH):
+    # Add only the daily reports that aren't in the processed dataset yet, as a new batch of fragments.
+    # Returns the filenames of the reports that were added
+    manifest = Manifest(manifest_path)
+    reports = daily_reports()
+
+    processed = [
+        filename
+        for filename in reports
+        if (manifest.get(filename) or {}).get("processed")
+    ]
+
+    # A processed dataset written before the manifest tracked it can't be appended to safely
+    if len(processed) == 0 and len(os.listdir(processed_path)) > 0:
+        print("Processed data isn't tracked by the manifest, rebuilding it...")
+        rebuild_processed(processed_path, manifest_path)
+        return list(reports)
+
+    new_reports = [filename for filename in reports if filename not in processed]
+
+    if len(new_reports) == 0:
+        return []
+
+    # A record is only kept in the first report it appears in, so when a report comes in that's
+    #  older than some already processed (re-downloaded because it changed, or published late), the
+    #  reports after it are added again along with it
+    first_date = min(report_date(filename) for filename in new_reports)
+    new_reports = [
+        filename
+        for filename in reports
+        if filename in new_reports or report_date(filename) >= first_date
+    ]
+    remove_reports(
+        [report_date(filename) for filename in new_reports], processed_path
+    )
+
+    new_reports = {filename: reports[filename] for filename in new_reports}
+    new_ids = ds.dataset(list(new_reports.values()), format="parquet").to_table(
+        columns=["Dissemination Identifier"]
+    )
+
+    # e.g. "batch-20240502T231500" for the reports added by tonight's run
+    name = "batch-" + datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    # Only records that aren't in the processed data yet are added
+    write_fragments(
+        new_reports,
+        name,
+        processed_path,
+        processed_keys(processed_path, new_ids.column("Dissemination Identifier")),
+    )
+
+    for filename in new_reports:
+        manifest.update(filename, {"processed": name})
+    manifest.save()
+
+    return new_reports
+
+
+def write_sorted(table, path):
+    # Write a merged processed file, sorted by SORT_KEY
+    write_table_atomic(
+        table,
+        path,
+        row_group_size=MIN_ROWS_PER_GROUP,
+        **writer_options(table.schema, sorted_by=[SORT_KEY]),
+    )
+
+
+def remove_reports(dates, processed_path=PROCESSED_PATH):
+    # Remove the rows of the reports dated `dates` from the processed dataset.  Daily fragments go
+    #  whole; compacted files are rewritten without them.  Only the compacted files of the dates'
+    #  months are opened, and those are only read in full when they hold one of the dates
+    months = {f"Report month={date:%Y-%m}" for date in dates}
+
+    for fragment in open_dataset(processed_path).get_fragments():
+        keys = ds.get_partition_keys(fragment.partition_expression)
+
+        if "Report date" in keys:
+            if keys["Report date"] in dates:
+                remove_fragment(fragment.path, processed_path)
+            continue
+
+        month = os.path.basename(os.path.dirname(os.path.dirname(fragment.path)))
+        if month not in months:
+            continue
+
+        parquet_file = pq.ParquetFile(fragment.path)
+        removed = pc.is_in(
+            parquet_file.read(columns=["Report date"]).column("Report date"),
+            pa.array(dates, pa.date32()),
+        )
+
+        if not pc.any(removed).as_py():
+            continue
+
+        table = parquet_file.read().filter(pc.invert(removed))
+
+        if table.num_rows == 0:
+            remove_fragment(fragment.path, processed_path)
+        else:
+            write_sorted(table, fragment.path)
+
+
+def compacted_directory(fragment, processed_path=PROCESSED_PATH):
+    # Where a fragment's rows go when it's compacted: "Report month=2024-05/Asset Class=EQ".  Compacted
+    #  files keep "Report date" as a column, and hive discovery only takes "Asset Class" from the path
+    report_date = ds.get_partition_keys(fragment.partition_expression).get("Report date")
+
+    if report_date is None:
+        return os.path.dirname(fragment.path)
+
+    return os.path.join(
+        processed_path,
+        f"Report month={report_date:%Y-%m}",
+        os.path.basename(os.path.dirname(fragment.path)),
+    )
+
+
+def remove_fragment(path, processed_path=PROCESSED_PATH):
+    # Delete a fragment, and its partition directories once they're empty
+    os.remove(path)
+
+    directory = os.path.dirname(path)
+    while os.path.abspath(directory) != os.path.abspath(processed_path):
+        if len(os.listdir(directory)) > 0:
+            break
+
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+
+def compact_processed(
+    processed_path=PROCESSED_PATH,
+    min_rows=COMPACT_MIN_ROWS,
+    max_small_files=COMPACT_MAX_SMALL_FILES,
+):
+    # Each report adds its own small fragments, one per report date and asset class.  Once there are
+    #  more than `max_small_files` fragments with fewer than `min_rows` rows, merge the small fragments
+    #  of each month and asset class into one sorted file.
+    # Returns whether any fragments were merged
+    dataset = open_dataset(processed_path)
+    small = [
+        fragment
+        for fragment in dataset.get_fragments()
+        if fragment.metadata.num_rows < min_rows
+    ]
+
+    if len(small) <= max_small_files:
+        return False
+
+    months = defaultdict(list)
+    for fragment in small:
+        months[compacted_directory(fragment, processed_path)].append(fragment)
+
+    name = "compacted-" + datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    compacted = False
+
+    for directory, fragments in months.items():
+        if len(fragments) < 2:
+            continue
+
+        # Read through the dataset so each row gets its "Report date", wherever it came from
+        table = ds.FileSystemDataset(
+            fragments, dataset.schema, dataset.format, dataset.filesystem
+        ).to_table()
+        table = table.drop_columns("Asset Class").sort_by(SORT_KEY)
+
+        os.makedirs(directory, exist_ok=True)
+        write_sorted(table, os.path.join(directory, f"{name}-0.parquet"))
+
+        for fragment in fragments:
+            remove_fragment(fragment.path, processed_path)
+
+        compacted = True
+
+    return compacted
@@ -0,0 +1,48 @@
+import pyarrow.parquet as pq
+import json
+import os
+from config import PROGENITOR_CACHE_PATH
+from write_options import file_checksum, write_table_atomic
+
+# The progenitors found by the last run of correlate_swaps.py, stored with a fingerprint of the swaps
+#  dataset they were found from: the sha256 checksum of each of its fragments, by path relative to the
+#  dataset.  swaps.py rewrites the swaps on every run, so fragments are compared by content, not mtime
+FINGERPRINT_KEY = b"fingerprint"
+
+
+def dataset_fingerprint(dataset, base_path):
+    return {
+        os.path.relpath(fragment.path, base_path): file_checksum(fragment.path)
+        for fragment in dataset.get_fragments()
+    }
+
+
+def load_cache(cache_path=PROGENITOR_CACHE_PATH):
+    # Returns (progenitors, fingerprint), or (None, None) if nothing is cached
+    if not os.path.exists(cache_path):
+        return None, None
+
+    table = pq.read_table(cache_path)
+    fingerprint = json.loads(table.schema.metadata[FINGERPRINT_KEY])
+
+    return table.replace_schema_metadata(None), fingerprint
+
+
+def save_cache(progenitors, fingerprint, cache_path=PROGENITOR_CACHE_PATH):
+    table = progenitors.replace_schema_metadata(
+        {FINGERPRINT_KEY: json.dumps(fingerprint, sort_keys=True)}
+    )
+    write_table_atomic(table, cache_path, compression="zstd")
+
+
+def added_fragments(cached_fingerprint, fingerprint):
+    # The fragments added since the cache was written, or None if any cached fragment has changed or
+    #  gone, in which case the cache can't be extended and everything must be resolved again
+    if cached_fingerprint is None:
+        return None
+
+    for fragment, checksum in cached_fingerprint.items():
+        if fingerprint.get(fragment) != checksum:
+            return None
+
+    return sorted(set(fingerprint) - set(cached_fingerprint))
@@ -1,4 +1,5 @@
 import pyarrow as pa
+import pyarrow.compute as pc
 
 
 def make_fields_optional(schema):
@@ -7,6 +8,32 @@ def make_fields_optional(schema):
     )
 
 
+# Amounts DTCC reports as text, e.g. "1,000,000+" for a notional capped at 1,000,000.  Each is also
+#  stored parsed, as "<column> value" (float64) and "<column> capped" (whether it ended in "+")
+AMOUNT_COLUMNS = [
+    "Notional amount-Leg 1",
+    "Notional amount-Leg 2",
+    "Price",
+    "Strike Price",
+    "Total notional quantity-Leg 1",
+    "Total notional quantity-Leg 2",
+    "Other payment amount",
+]
+
+
+def amount_fields():
+    fields = []
+    for name in AMOUNT_COLUMNS:
+        fields.append(pa.field(f"{name} value", pa.float64(), nullable=True))
+        fields.append(pa.field(f"{name} capped", pa.bool_(), nullable=True))
+
+    return fields
+
+
+def with_amount_fields(schema):
+    return pa.schema(list(schema) + amount_fields())
+
+
 PRE_2023 = make_fields_optional(
     pa.schema(
         [
@@ -515,6 +542,13 @@ CORRELATED_CUSTOM = make_fields_optional(
         ]
     )
 )
+CORRELATED_CUSTOM = with_amount_fields(CORRELATED_CUSTOM)
+
+# PHASE_2 plus the parsed amounts; the layout of the converted daily reports
+CONVERTED = with_amount_fields(PHASE_2)
+
+# CONVERTED plus the date of the daily report a row was read from
+PROCESSED = CONVERTED.append(pa.field("Report date", pa.date32(), nullable=True))
 
 
 def identify_schema(column_names):
@@ -528,21 +562,97 @@ def identify_schema(column_names):
     return None
 
 
+def conform_to_schema(table, schema):
+    # Select the schema's columns in order, filling any that are missing with nulls,
+    #  and cast the result in a single pass
+    columns = [
+        (
+            table.column(field.name)
+            if field.name in table.column_names
+            else pa.nulls(table.num_rows, type=field.type)
+        )
+        for field in schema
+    ]
+
+    return pa.table(columns, names=schema.names).cast(schema)
+
+
+def parse_amounts(column):
+    # (values, capped) for a text column of amounts like "1,000,000+", parsed with vectorized kernels.
+    # Anything that isn't a plain number once the thousands separators and trailing "+" are removed
+    #  is left null
+    text = pc.utf8_trim_whitespace(column.cast(pa.string()))
+    capped = pc.ends_with(text, "+")
+
+    number = pc.replace_substring_regex(text, r",|\+$", "")
+    valid = pc.match_substring_regex(number, r"^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+    values = pc.if_else(valid, number, pa.scalar(None, pa.string())).cast(pa.float64())
+
+    return values, pc.if_else(pc.equal(text, ""), pa.scalar(None, pa.bool_()), capped)
+
+
+def add_amounts(table):
+    # `table` with the parsed AMOUNT_COLUMNS appended after its own columns, replacing any already there
+    table = table.drop_columns(
+        [field.name for field in amount_fields() if field.name in table.column_names]
+    )
+
+    for name in AMOUNT_COLUMNS:
+        column = (
+            table.column(name)
+            if name in table.column_names
+            else pa.nulls(table.num_rows, pa.string())
+        )
+        values, capped = parse_amounts(column)
+
+        table = table.append_column(f"{name} value", values)
+        table = table.append_column(f"{name} capped", capped)
+
+    return table
+
+
+def column_mapping(schema):
+    # Source column name -> PHASE_2 column name (None for columns that have no equivalent)
+    if schema is PRE_2023:
+        return PRE_2023_TO_PHASE_2
+    elif schema is PRE_PHASE_2:
+        return PRE_PHASE_2_TO_PHASE_2
+
+    return {}
+
+
+def coalesce_columns(first, second, column_type):
+    # Take values from the first column, falling back to the second where the first is null or empty
+    first = first.cast(column_type)
+    if pa.types.is_string(column_type):
+        first = pc.if_else(pc.equal(first, ""), pa.scalar(None, column_type), first)
+
+    return pc.coalesce(first, second.cast(column_type))
+
+
 def map_columns(table):
-    if "Primary Asset Class" in table.column_names:
-        map = {
-            name: value
-            for name, value in PRE_2023_TO_PHASE_2.items()
-            if value is not None
-        }
-        table = table.rename_columns(map)
-    elif "Call amount-Leg 1" in table.column_names:
-        map = {
-            name: value
-            for name, value in PRE_PHASE_2_TO_PHASE_2.items()
-            if value is not None
-        }
-        table = table.rename_columns(map)
+    # Normalize a table from any report layout to PHASE_2.  Source column names never collide with
+    #  PHASE_2 names, so this also finishes tables that were only partially renamed while parsing
+    mapping = {**PRE_2023_TO_PHASE_2, **PRE_PHASE_2_TO_PHASE_2}
+
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        target = mapping.get(name, name)
+
+        if target is None:
+            continue
+
+        # Several legacy columns can map onto the same PHASE_2 column
+        if target in columns:
+            columns[target] = coalesce_columns(
+                columns[target], column, PHASE_2.field(target).type
+            )
+        else:
+            columns[target] = column
+
+    table = pa.table(list(columns.values()), names=list(columns.keys()))
+
+    return conform_to_schema(table, PHASE_2)
 
 
 PRE_2023_TO_PHASE_2 = {
@@ -0,0 +1,152 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import os
+from collections import defaultdict
+from config import PROCESSED_PATH, UNDERLIER_INDEX_PATH
+from extract import normalize_underliers, normalized_pattern
+from processed import open_dataset
+from write_options import write_table_atomic
+
+# One row per distinct underlier in each row group of the processed dataset, with the range of
+#  dissemination identifiers it covers there.  Fragment paths are relative to the processed folder,
+#  and "Modified" is the fragment's mtime when it was indexed, so rewritten fragments are re-indexed
+INDEX_SCHEMA = pa.schema(
+    [
+        pa.field("Underlier", pa.string()),
+        pa.field("Fragment", pa.string()),
+        pa.field("Modified", pa.int64()),
+        pa.field("Row group", pa.int32()),
+        pa.field("Min Dissemination Identifier", pa.int64()),
+        pa.field("Max Dissemination Identifier", pa.int64()),
+        pa.field("Rows", pa.int64()),
+    ]
+)
+
+
+def index_fragment(path, processed_path=PROCESSED_PATH):
+    # Read only the two indexed columns, one row group at a time
+    parquet_file = pq.ParquetFile(path)
+    fragment = os.path.relpath(path, processed_path)
+    modified = os.stat(path).st_mtime_ns
+    tables = []
+
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(
+            row_group, columns=["Underlier ID-Leg 1", "Dissemination Identifier"]
+        )
+        table = pa.table(
+            {
+                "Underlier": normalize_underliers(table.column("Underlier ID-Leg 1")),
+                "Dissemination Identifier": table.column("Dissemination Identifier"),
+            }
+        ).filter(ds.field("Underlier").is_valid())
+
+        summary = table.group_by("Underlier").aggregate(
+            [
+                ("Dissemination Identifier", "min"),
+                ("Dissemination Identifier", "max"),
+                ("Dissemination Identifier", "count"),
+            ]
+        )
+
+        tables.append(
+            pa.table(
+                [
+                    summary.column("Underlier"),
+                    pa.repeat(pa.scalar(fragment), summary.num_rows),
+                    pa.repeat(pa.scalar(modified), summary.num_rows),
+                    pa.repeat(pa.scalar(row_group, pa.int32()), summary.num_rows),
+                    summary.column("Dissemination Identifier_min"),
+                    summary.column("Dissemination Identifier_max"),
+                    summary.column("Dissemination Identifier_count"),
+                ],
+                schema=INDEX_SCHEMA,
+            )
+        )
+
+    return pa.concat_tables(tables) if tables else INDEX_SCHEMA.empty_table()
+
+
+def load_index(index_path=UNDERLIER_INDEX_PATH):
+    if not os.path.exists(index_path):
+        return INDEX_SCHEMA.empty_table()
+
+    return pq.read_table(index_path, schema=INDEX_SCHEMA)
+
+
+def update_index(processed_path=PROCESSED_PATH, index_path=UNDERLIER_INDEX_PATH):
+    # Bring the index in line with the processed dataset: drop fragments that were compacted away
+    #  and index only the fragments it hasn't seen
+    index = load_index(index_path)
+
+    fragments = {
+        os.path.relpath(fragment.path, processed_path): fragment.path
+        for fragment in open_dataset(processed_path).get_fragments()
+    }
+
+    # Keep the entries of fragments that are still there, unchanged since they were indexed
+    recorded = index.group_by(["Fragment", "Modified"]).aggregate([])
+    up_to_date = {
+        fragment
+        for fragment, modified in zip(
+            recorded.column("Fragment").to_pylist(),
+            recorded.column("Modified").to_pylist(),
+        )
+        if fragment in fragments and os.stat(fragments[fragment]).st_mtime_ns == modified
+    }
+
+    index = index.filter(
+        pc.is_in(index.column("Fragment"), pa.array(list(up_to_date), pa.string()))
+    )
+
+    new_fragments = [
+        path for fragment, path in fragments.items() if fragment not in up_to_date
+    ]
+
+    if len(new_fragments) == 0 and os.path.exists(index_path):
+        return index
+
+    index = pa.concat_tables(
+        [index] + [index_fragment(path, processed_path) for path in new_fragments]
+    ).sort_by([("Underlier", "ascending"), ("Fragment", "ascending")])
+
+    write_table_atomic(index, index_path, compression="zstd")
+
+    return index
+
+
+def locate(index, underlier_ids):
+    # {fragment: [row groups]} holding any underlier that contains one of `underlier_ids`.
+    # The index only has one row per underlier and row group, so matching it is cheap
+    matches = index.filter(
+        pc.match_substring_regex(
+            index.column("Underlier"), normalized_pattern(underlier_ids)
+        )
+    )
+
+    locations = defaultdict(set)
+    for fragment, row_group in zip(
+        matches.column("Fragment").to_pylist(), matches.column("Row group").to_pylist()
+    ):
+        locations[fragment].add(row_group)
+
+    return {fragment: sorted(row_groups) for fragment, row_groups in locations.items()}
+
+
+def narrow_dataset(dataset, index, underlier_ids, processed_path=PROCESSED_PATH):
+    # `dataset` reduced to the row groups that can hold swaps on `underlier_ids`, so a scan of it
+    #  reads only those instead of the whole processed dataset
+    locations = locate(index, underlier_ids)
+
+    fragments = []
+    for fragment in dataset.get_fragments():
+        relative_path = os.path.relpath(fragment.path, processed_path)
+
+        if relative_path in locations:
+            fragments.append(fragment.subset(row_group_ids=locations[relative_path]))
+
+    return ds.FileSystemDataset(
+        fragments, dataset.schema, dataset.format, dataset.filesystem
+    )
@@ -0,0 +1,72 @@
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import hashlib
+import inspect
+import os
+from config import PARQUET_PROFILE
+
+# Bloom filters are only written by pyarrow versions whose ParquetWriter takes this option; older
+#  ones reject it, so it's dropped for them
+WRITES_BLOOM_FILTERS = (
+    "bloom_filter_options" in inspect.signature(pq.ParquetWriter.__init__).parameters
+)
+
+
+def writer_options(schema, sorted_by=None, profile=PARQUET_PROFILE):
+    # ParquetWriter keyword arguments for a file with `schema`, from the configured profile.
+    # `sorted_by` names the columns the file's rows are sorted by, recorded in the file metadata
+    options = dict(profile)
+
+    for key in ("use_dictionary", "write_statistics"):
+        if isinstance(options.get(key), list):
+            options[key] = [name for name in options[key] if name in schema.names]
+
+    if not WRITES_BLOOM_FILTERS:
+        options.pop("bloom_filter_options", None)
+    elif options.get("bloom_filter_options"):
+        options["bloom_filter_options"] = {
+            name: value
+            for name, value in options["bloom_filter_options"].items()
+            if name in schema.names
+        }
+
+    if sorted_by:
+        options["sorting_columns"] = list(
+            pq.SortingColumn.from_ordering(
+                schema, [(name, "ascending") for name in sorted_by]
+            )
+        )
+
+    return options
+
+
+def file_options(schema, sorted_by=None, profile=PARQUET_PROFILE):
+    # The same options for ds.write_dataset
+    return ds.ParquetFileFormat().make_write_options(
+        **writer_options(schema, sorted_by, profile)
+    )
+
+
+def partial_path(path):
+    # The hidden temporary name `path` is written under before it's moved into place, so a partly
+    #  written file is never mistaken for a finished one (dataset discovery skips "." names too)
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".partial")
+
+
+def write_table_atomic(table, path, **options):
+    # pq.write_table through partial_path, so an interrupted write never leaves a truncated file
+    partial = partial_path(path)
+    pq.write_table(table, partial, **options)
+    os.replace(partial, path)
+
+
+def file_checksum(path):
+    # sha256 of a file's contents, read in 1 MiB chunks
+    checksum = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()